@@ -23,6 +23,8 @@ setup(name='yunpipe2',
               'wrap = yunpipe.scripts.wrap:main',
               'clean-up = yunpipe.pipeline.cleanup:main',
               'setup-pipe = yunpipe.scripts.setup_pipe:main',
+              'profile-algorithm = yunpipe.scripts.profile_algorithm:main',
+              'yunpipe-scheduler = yunpipe.scripts.scheduler:main',
               'create-lambda-exec-role = yunpipe.pipeline.set_pipe:create_lambda_exec_role']
       },
       include_package_data=True,
@@ -0,0 +1,80 @@
+'''
+stand-ins of boto3 and botocore for running the tests where they are not
+installed. No test talks to aws: every call of a stubbed client fails, and
+tests replace the clients they use.
+'''
+import os
+import sys
+import types
+from importlib.util import find_spec
+
+
+class ClientError(Exception):
+
+    def __init__(self, error_response, operation_name):
+        super().__init__('{}: {}'.format(
+            operation_name, error_response['Error'].get('Code')))
+        self.response = error_response
+        self.operation_name = operation_name
+
+
+class TransferConfig:
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class stub_client:
+    '''
+    client of a service failing every call
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, operation):
+        def call(*args, **kwargs):
+            raise ClientError({'Error': {'Code': 'Stubbed'}},
+                              self.name + '.' + operation)
+        return call
+
+
+class Session:
+
+    def __init__(self, **kwargs):
+        self.region_name = kwargs.get('region_name')
+
+    def client(self, name, **kwargs):
+        return stub_client(name)
+
+    def resource(self, name, **kwargs):
+        return stub_client(name)
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    '''
+    put the stand-ins into sys.modules unless boto3 is installed, and set
+    the aws settings yunpipe.pipeline would otherwise ask for
+    '''
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_DEFAULT_OUTPUT', 'json')
+    if 'boto3' in sys.modules or find_spec('boto3'):
+        return
+
+    exceptions = _module('botocore.exceptions', ClientError=ClientError)
+    _module('botocore', exceptions=exceptions)
+    session = _module('boto3.session', Session=Session)
+    transfer = _module('boto3.s3.transfer', TransferConfig=TransferConfig)
+    s3 = _module('boto3.s3', transfer=transfer)
+    _module('boto3', session=session, s3=s3,
+            client=lambda name, **kwargs: stub_client(name),
+            resource=lambda name, **kwargs: stub_client(name))
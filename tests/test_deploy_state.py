@@ -0,0 +1,98 @@
+import unittest
+
+import stubs
+
+stubs.install()
+
+from yunpipe.pipeline.deploy_state import diff_stages  # noqa: E402
+from yunpipe.pipeline.deploy_state import estimate_calls  # noqa: E402
+from yunpipe.pipeline.deploy_state import format_plan  # noqa: E402
+from yunpipe.pipeline.deploy_state import stage_resources  # noqa: E402
+from yunpipe.pipeline.deploy_state import stage_spec  # noqa: E402
+
+
+def deployed_stage(name, spec, **settings):
+    return dict(settings, name=name, spec=spec)
+
+
+class test_diff_stages(unittest.TestCase):
+
+    def test_changed_and_added(self):
+        deployed = [deployed_stage('a', 'x'), deployed_stage('b', 'old')]
+        self.assertEqual(diff_stages(['x', 'y', 'z'], deployed),
+                         [('keep', 0), ('replace', 1), ('create', 2)])
+
+    def test_removed(self):
+        deployed = [deployed_stage('a', 'x'), deployed_stage('b', 'y')]
+        self.assertEqual(diff_stages(['x'], deployed),
+                         [('keep', 0), ('delete', 1)])
+
+    def test_never_deployed(self):
+        self.assertEqual(diff_stages(['x'], []), [('create', 0)])
+
+    def test_spec_ignores_queue(self):
+        request = {'name': 'alg', 'output_s3_name': 'out'}
+        spec = stage_spec(request, {'cpu': 1}, {'lambda': {}}, {})
+
+        self.assertEqual(
+            stage_spec(dict(request, sqs='url'), {'cpu': 1}, {'lambda': {}},
+                       {}), spec)
+        self.assertNotEqual(
+            stage_spec(request, {'cpu': 2}, {'lambda': {}}, {}), spec)
+        self.assertNotEqual(
+            stage_spec(request, {'cpu': 1}, {'lambda': {'memory': 512}},
+                       {}), spec)
+
+
+class test_plan(unittest.TestCase):
+
+    wanted = [{'name': 'a', 'mode': 'task'},
+              {'name': 'b', 'mode': 'service'},
+              {'name': 'c', 'mode': 'task', 'scheduler': True}]
+    deployed = [deployed_stage('a', 'x', mode='task'),
+                deployed_stage('b', 'y', mode='task'),
+                deployed_stage('d', 'z', mode='task', scheduler=True),
+                deployed_stage('e', 'w', mode='service')]
+    changes = [('keep', 0), ('replace', 1), ('create', 2), ('delete', 3)]
+
+    def test_stage_resources(self):
+        self.assertEqual(stage_resources(self.wanted[0]), ['task', 'lambda'])
+        self.assertEqual(stage_resources(self.wanted[1]),
+                         ['task', 'service'])
+        self.assertEqual(stage_resources(self.wanted[2]), ['task'])
+        self.assertEqual(stage_resources({}), ['task', 'lambda'])
+
+    def test_estimate_calls(self):
+        calls = estimate_calls(self.changes, self.wanted, self.deployed,
+                               ['out'], ['old'], ['role'])
+        # role 2, bucket 2 and unhook 1; replace: task 1, service 4, event
+        # 3, delete task 1 and lambda 1; create: queue 2, task 1, event 3;
+        # delete: task 1, service 3 and queue 1
+        self.assertEqual(calls, 5 + 10 + 6 + 5)
+
+    def test_estimate_nothing(self):
+        self.assertEqual(estimate_calls([('keep', 0)], self.wanted,
+                                        self.deployed, [], [], []), 0)
+
+    def test_format_plan(self):
+        self.assertEqual(
+            format_plan('p', self.changes, self.wanted, self.deployed,
+                        ['out'], ['old'], 26).split('\n'),
+            ['pipeline p:',
+             '  + s3 bucket out',
+             '  = stage 0 a',
+             '  ~ stage 1 b: new task definition, ecs service, queue kept',
+             '  + stage 2 c: queue, task definition',
+             '  - stage 3 e: task definition, ecs service, queue',
+             '  - s3 bucket old event notification',
+             'estimated api calls: 26'])
+
+    def test_format_no_changes(self):
+        self.assertEqual(
+            format_plan('p', [('keep', 0)], self.wanted, self.deployed, [],
+                        [], 0),
+            'pipeline p:\n  = stage 0 a\nno changes')
+
+
+if __name__ == '__main__':
+    unittest.main()
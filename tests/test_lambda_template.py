@@ -0,0 +1,183 @@
+import os
+import unittest
+
+import stubs
+
+stubs.install()
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'yunpipe',
+                        'templates', 'lambda_run_task_template.txt')
+
+
+def render_lambda(**values):
+    '''
+    render the lambda function template of a stage running on m5.large or
+    c5.large with the shared snapshot kept in the lambda container
+
+    rtype: dict, globals of the lambda function
+    '''
+    settings = {'instance_types': "['m5.large', 'c5.large']",
+                'cpu': 1024, 'memory': 2048, 'files_per_task': 10,
+                'max_tasks': 5, 'placement': 'bestfit', 'state_table': '',
+                'capacity_provider': ''}
+    settings.update(values)
+    for name in ('account_id', 'alarm_sqs', 'iam_name', 'image_id',
+                 'key_pair', 'region', 'security_group', 'sqs',
+                 'subnet_id', 'task_name'):
+        settings.setdefault(name, name)
+    with open(TEMPLATE, 'r') as tmpfile:
+        source = tmpfile.read() % settings
+    function = {'__name__': 'lambda_function'}
+    exec(compile(source, 'lambda_function.py', 'exec'), function)
+    return function
+
+
+def instance(arn, cpu, memory, instance_type='m5.large', total_cpu=2048,
+             total_memory=8192, connected=True):
+    return {'arn': arn, 'ec2': 'i-' + arn, 'type': instance_type,
+            'connected': connected, 'cpu': cpu, 'memory': memory,
+            'total_cpu': total_cpu, 'total_memory': total_memory}
+
+
+class test_snapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.function = render_lambda()
+        self.described = []
+        self.function['describe_cluster'] = self.describe
+
+    def describe(self, cluster):
+        self.described.append(cluster)
+        return [instance('a', 2048, 8192), instance('b', 1024, 8192)]
+
+    def test_write_checks_version(self):
+        write = self.function['write_snapshot']
+        snapshot = {'expires': 1, 'instances': []}
+
+        self.assertTrue(write('default', snapshot, 0))
+        self.assertEqual(snapshot['version'], 1)
+        self.assertFalse(write('default', {'expires': 2, 'instances': []},
+                               0))
+        self.assertEqual(
+            self.function['read_snapshot']('default')['expires'], 1)
+
+    def test_read_is_a_copy(self):
+        self.function['write_snapshot'](
+            'default', {'expires': 1, 'instances': [instance('a', 1, 1)]}, 0)
+        read = self.function['read_snapshot']
+        read('default')['instances'][0]['cpu'] = 0
+
+        self.assertEqual(read('default')['instances'][0]['cpu'], 1)
+
+    def test_plan_takes_resources(self):
+        plan, _ = self.function['plan_tasks']('default', 4)
+        self.assertEqual(sorted(plan), ['a', 'a', 'b'])
+
+        # the next function sees the placed tasks in the snapshot
+        snapshot = self.function['read_snapshot']('default')
+        self.assertEqual(snapshot['version'], 2)
+        self.assertEqual([i['cpu'] for i in snapshot['instances']], [0, 0])
+        self.assertEqual(self.function['plan_tasks']('default', 1)[0], [])
+        self.assertEqual(self.described, ['default'])
+
+    def test_plan_fresh_describes_again(self):
+        self.function['plan_tasks']('default', 1)
+        plan, _ = self.function['plan_tasks']('default', 1, fresh=True)
+
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(self.described, ['default', 'default'])
+
+    def test_plan_again_after_conflict(self):
+        write = self.function['write_snapshot']
+        self.function['get_snapshot']('default')
+        conflicts = []
+
+        def write_after_other(cluster, snapshot, version):
+            # another function takes instance a before this one writes
+            if not conflicts:
+                other = self.function['read_snapshot'](cluster)
+                other['instances'][0]['cpu'] = 0
+                conflicts.append(write(cluster, other, other['version']))
+            return write(cluster, snapshot, version)
+
+        self.function['write_snapshot'] = write_after_other
+        plan, _ = self.function['plan_tasks']('default', 3)
+
+        self.assertEqual(conflicts, [True])
+        self.assertEqual(plan, ['b'])
+        snapshot = self.function['read_snapshot']('default')
+        self.assertEqual(snapshot['version'], 3)
+        self.assertEqual([i['cpu'] for i in snapshot['instances']], [0, 0])
+
+
+class test_choose_instance(unittest.TestCase):
+
+    instances = [instance('small', 1024, 2048, total_cpu=1024,
+                          total_memory=2048),
+                 instance('large', 4096, 16384, total_cpu=4096,
+                          total_memory=16384),
+                 instance('used', 1536, 4096)]
+
+    def choose(self, placement, instances=None):
+        function = render_lambda(placement=placement)
+        chosen = function['choose_instance'](instances or self.instances,
+                                             1024, 2048)
+        return chosen and chosen['arn']
+
+    def test_bestfit(self):
+        self.assertEqual(self.choose('bestfit'), 'small')
+
+    def test_binpack(self):
+        self.assertEqual(self.choose('binpack'), 'small')
+        self.assertEqual(self.choose('binpack', self.instances[1:]), 'used')
+
+    def test_spread(self):
+        self.assertEqual(self.choose('spread'), 'large')
+
+    def test_skips_other_instances(self):
+        instances = [instance('t3', 4096, 16384, instance_type='t3.large'),
+                     instance('gone', 4096, 16384, connected=False),
+                     instance('full', 512, 16384),
+                     instance('c5', 2048, 4096, instance_type='c5.large')]
+        self.assertEqual(self.choose('bestfit', instances), 'c5')
+        self.assertIsNone(self.choose('bestfit', instances[:3]))
+
+
+class test_instances_needed(unittest.TestCase):
+
+    def needed(self, size, count, **values):
+        function = render_lambda(**values)
+        function['instance_sizes']['m5.large'] = size
+        return function['instances_needed']('m5.large', count)
+
+    def test_limited_by_cpu(self):
+        self.assertEqual(self.needed((2048, 7372), 5), 3)
+
+    def test_limited_by_memory(self):
+        self.assertEqual(self.needed((8192, 7372), 7, memory=3000), 4)
+
+    def test_task_without_cpu(self):
+        self.assertEqual(self.needed((2048, 7372), 7, cpu=0), 3)
+
+    def test_task_larger_than_instance(self):
+        self.assertEqual(self.needed((2048, 7372), 2, memory=8000), 2)
+
+    def test_size_described_once(self):
+        function = render_lambda()
+        calls = []
+
+        class ec2:
+            def describe_instance_types(self, InstanceTypes):
+                calls.append(InstanceTypes)
+                return {'InstanceTypes': [{'MemoryInfo': {'SizeInMiB': 8192},
+                                           'VCpuInfo': {'DefaultVCpus': 2}}]}
+
+        function['clients']['ec2'] = ec2()
+        self.assertEqual(function['instances_needed']('m5.large', 3), 2)
+        self.assertEqual(function['instances_needed']('m5.large', 4), 2)
+        self.assertEqual(calls, [['m5.large']])
+        self.assertEqual(function['instance_sizes']['m5.large'], (2048, 7372))
+
+
+if __name__ == '__main__':
+    unittest.main()
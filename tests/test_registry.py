@@ -0,0 +1,61 @@
+import json
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import stubs
+
+stubs.install()
+
+from yunpipe.pipeline.registry import resource_registry  # noqa: E402
+
+
+class test_registry(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.file_path = os.path.join(self.root, 'registry.json')
+
+    def tearDown(self):
+        rmtree(self.root, ignore_errors=True)
+
+    def test_add_and_get(self):
+        registry = resource_registry(self.file_path)
+        registry.add('sqs', 'q1', 'url1')
+
+        self.assertEqual(registry.get('sqs', 'q1'), 'url1')
+        self.assertIsNone(registry.get('sqs', 'q2'))
+        self.assertIsNone(registry.get('lambda', 'q1'))
+
+    def test_kept_in_file(self):
+        resource_registry(self.file_path).add('sqs', 'q1', 'url1')
+
+        self.assertEqual(resource_registry(self.file_path).get('sqs', 'q1'),
+                         'url1')
+        with open(self.file_path, 'r') as data_file:
+            self.assertEqual(json.load(data_file), {'sqs': {'q1': 'url1'}})
+        self.assertEqual(os.listdir(self.root), ['registry.json'])
+
+    def test_forget_every_name_of_value(self):
+        registry = resource_registry(self.file_path)
+        registry.add('sqs', 'q1', 'url1')
+        registry.add('sqs', 'alias', 'url1')
+        registry.add('sqs', 'q2', 'url2')
+        registry.forget('sqs', 'url1')
+        registry.forget('lambda', 'url2')
+
+        reloaded = resource_registry(self.file_path)
+        self.assertIsNone(reloaded.get('sqs', 'q1'))
+        self.assertIsNone(reloaded.get('sqs', 'alias'))
+        self.assertEqual(reloaded.get('sqs', 'q2'), 'url2')
+
+    def test_missing_or_broken_file(self):
+        self.assertEqual(resource_registry(self.file_path).resources, {})
+        with open(self.file_path, 'w') as data_file:
+            data_file.write('{broken')
+        self.assertEqual(resource_registry(self.file_path).resources, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import io
+import json
+import os
+import unittest
+import zipfile
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import stubs
+
+stubs.install()
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'yunpipe',
+                        'templates', 'runscript_template.txt')
+
+
+def render_runscript(command='cp $input $output'):
+    '''
+    render the runscript template for algorithm alg in a temporary folder
+
+    rtype: tuple, globals of the runscript and the temporary folder
+    '''
+    root = mkdtemp()
+    os.makedirs(os.path.join(root, 'in'))
+    os.makedirs(os.path.join(root, 'out'))
+    with open(TEMPLATE, 'r') as tmpfile:
+        source = tmpfile.read() % {'input': root + '/in/',
+                                   'output': root + '/out/', 'name': 'alg',
+                                   'command': command}
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['output_s3_name'] = 'outb'
+    runscript = {'__name__': 'runscript'}
+    exec(compile(source, 'runscript.py', 'exec'), runscript)
+    return runscript, root
+
+
+class fake_s3:
+    '''
+    s3 client keeping objects of the output bucket in a dict
+    '''
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.copies = []
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[Key])}
+
+    def copy(self, CopySource, Bucket, Key):
+        self.copies.append((CopySource['Key'], Key))
+        self.objects[Key] = self.objects[CopySource['Key']]
+
+
+class test_result_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.runscript, self.root = render_runscript()
+
+    def tearDown(self):
+        rmtree(self.root, ignore_errors=True)
+
+    def cache(self, cached_key, cached_input):
+        s3 = fake_s3({
+            '.yunpipe-cache/k': json.dumps({
+                'key': cached_key, 'input': 'inb/' + cached_input,
+                'etag': 'e'}).encode(),
+            cached_key: b'result'})
+        self.runscript['s3'] = s3
+        return s3
+
+    def test_hit_of_different_name(self):
+        s3 = self.cache('d/Result-alg-a.txt', 'd/a.txt')
+        job = {'bucket': 'inb', 'file': 'd3/z.txt', 'cache_key': 'k'}
+
+        self.assertTrue(self.runscript['copy_cached_result'](job))
+        self.assertEqual(job['result'], 'd3/Result-alg-z.txt')
+        self.assertEqual(s3.copies,
+                         [('d/Result-alg-a.txt', 'd3/Result-alg-z.txt')])
+
+    def test_hit_keeps_input_extension(self):
+        self.cache('d/Result-alg-a.txt', 'd/a.txt')
+        job = {'bucket': 'inb', 'file': 'd/z.csv', 'cache_key': 'k'}
+
+        self.assertTrue(self.runscript['copy_cached_result'](job))
+        self.assertEqual(job['result'], 'd/Result-alg-z.csv')
+
+    def test_hit_of_archive(self):
+        self.cache('d/Result-alg-a.tar.zst', 'd/a.nii.gz')
+        job = {'bucket': 'inb', 'file': 'e/z.nii.gz', 'cache_key': 'k'}
+
+        self.assertTrue(self.runscript['copy_cached_result'](job))
+        self.assertEqual(job['result'], 'e/Result-alg-z.tar.zst')
+
+    def test_hit_of_same_key(self):
+        s3 = self.cache('d/Result-alg-a.txt', 'd/a.txt')
+        job = {'bucket': 'inb', 'file': 'd/a.txt', 'cache_key': 'k'}
+
+        self.assertTrue(self.runscript['copy_cached_result'](job))
+        self.assertEqual(job['result'], 'd/Result-alg-a.txt')
+        self.assertEqual(s3.copies, [])
+
+
+
+class test_zip_writer(unittest.TestCase):
+
+    def setUp(self):
+        self.runscript, self.root = render_runscript()
+        self.files = {'a.txt': b'alpha ' * 1000, 'd/b.bin': os.urandom(3000),
+                      'empty': b''}
+        for name, data in self.files.items():
+            path = os.path.join(self.root, 'in', name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as tmpfile:
+                tmpfile.write(data)
+
+    def tearDown(self):
+        rmtree(self.root, ignore_errors=True)
+
+    def write(self, limit=None):
+        out = io.BytesIO()
+        archive = self.runscript['zip_writer'](out)
+        if limit is not None:
+            archive.LIMIT = limit
+        for name in sorted(self.files):
+            archive.add(name, self.runscript['deflate_member'](
+                os.path.join(self.root, 'in', name)))
+        archive.close()
+        self.assertEqual(archive.offset, len(out.getvalue()))
+        out.seek(0)
+        return zipfile.ZipFile(out)
+
+    def assert_members(self, archive):
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(sorted(archive.namelist()), sorted(self.files))
+        for name, data in self.files.items():
+            self.assertEqual(archive.read(name), data)
+
+    def test_deflated(self):
+        archive = self.write()
+        self.assert_members(archive)
+        self.assertEqual(archive.getinfo('a.txt').compress_type,
+                         zipfile.ZIP_DEFLATED)
+        self.assertLess(archive.getinfo('a.txt').compress_size, 6000)
+
+    def test_stored(self):
+        self.runscript['ARCHIVE_LEVEL'] = 0
+        archive = self.write()
+        self.assert_members(archive)
+        self.assertEqual(archive.getinfo('a.txt').compress_type,
+                         zipfile.ZIP_STORED)
+
+    def test_zip64(self):
+        # every size and offset over the limit goes into zip64 records
+        archive = self.write(limit=1)
+        self.assert_members(archive)
+        self.assertEqual(archive.getinfo('d/b.bin').file_size, 3000)
+
+    def test_write_zip(self):
+        out = io.BytesIO()
+        self.runscript['write_zip'](
+            [(os.path.join(self.root, 'in', name), 'x/' + name)
+             for name in sorted(self.files)], out)
+        out.seek(0)
+        archive = zipfile.ZipFile(out)
+        self.assertEqual(archive.namelist(),
+                         ['x/' + name for name in sorted(self.files)])
+        self.assertEqual(archive.read('x/d/b.bin'), self.files['d/b.bin'])
+
+
+if __name__ == '__main__':
+    unittest.main()
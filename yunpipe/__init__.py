@@ -5,7 +5,12 @@ from .utils import create_folder
 
 CLOUD_PIPE_TMP_FOLDER = get_full_path('~/.cloud_pipe/tmp')
 CLOUD_PIPE_ALGORITHM_FOLDER = get_full_path('~/.cloud_pipe/algorithms')
+# deployed state of each pipeline, see pipeline/deploy_state.py
+CLOUD_PIPE_PIPELINE_FOLDER = get_full_path('~/.cloud_pipe/pipelines')
+# aws resources created by yunpipe, see pipeline/registry.py
+CLOUD_PIPE_REGISTRY = get_full_path('~/.cloud_pipe/registry.json')
 CLOUD_PIPE_TEMPLATES_FOLDER = os.path.join(os.path.dirname(__file__), 'templates')
 
 create_folder(CLOUD_PIPE_TMP_FOLDER)
 create_folder(CLOUD_PIPE_ALGORITHM_FOLDER)
+create_folder(CLOUD_PIPE_PIPELINE_FOLDER)
@@ -4,11 +4,14 @@ import os.path
 import boto3
 from botocore.exceptions import ClientError
 
+from .registry import registry
+from .deploy_state import remove_all_manifests
 from .. import CLOUD_PIPE_TMP_FOLDER
 
 
 def _delete_queue(queue_url):
     boto3.client('sqs').delete_queue(QueueUrl=queue_url)
+    registry.forget('sqs', queue_url)
 
 
 def _delete_s3(bucket):
@@ -17,6 +20,7 @@ def _delete_s3(bucket):
     '''
     _delete_all_objects(bucket)
     boto3.client('s3').delete_bucket(Bucket=bucket)
+    registry.forget('s3', bucket)
 
 
 def _delete_all_objects(bucket):
@@ -35,6 +39,50 @@ def _delete_alarm(alarm_name):
     boto3.client('cloudwatch').delete_alarms(AlarmNames=[alarm_name])
 
 
+def _delete_service(name):
+    '''
+    stop scaling the ecs service of a stage in service mode, then delete it
+    with its running tasks
+    '''
+    _delete_alarm(name + '-backlog')
+    boto3.client('application-autoscaling').deregister_scalable_target(
+        ServiceNamespace='ecs', ResourceId='service/default/' + name,
+        ScalableDimension='ecs:service:DesiredCount')
+    boto3.client('ecs').delete_service(cluster='default', service=name,
+                                       force=True)
+
+
+def _release_capacity(name):
+    '''
+    let the auto scaling group of a capacity provider scale in to zero. The
+    group and capacity provider are shared by pipelines of the instance type
+    and kept.
+    '''
+    boto3.client('autoscaling').update_auto_scaling_group(
+        AutoScalingGroupName=name, MinSize=0)
+
+
+def _delete_scheduler_events(rule, queue):
+    '''
+    delete the EventBridge rule and queue yunpipe-scheduler receives ECS
+    events from. They exist only once the scheduler has run.
+    '''
+    events = boto3.client('events')
+    try:
+        events.remove_targets(Rule=rule, Ids=[queue])
+        events.delete_rule(Name=rule)
+    except ClientError as err:
+        print(err)
+
+    sqs = boto3.client('sqs')
+    try:
+        queue_url = sqs.get_queue_url(QueueName=queue)['QueueUrl']
+    except ClientError as err:
+        print(err)
+        return
+    _delete_queue(queue_url)
+
+
 def _delete_lambda_log(lambda_arn):
     name = '/aws/lambda/' + lambda_arn.split(':')[-1]
     boto3.client('logs').delete_log_group(logGroupName=name)
@@ -45,6 +93,10 @@ def main():
     with open(file_path, 'r') as tmpfile:
         info = json.load(tmpfile)
 
+    # service tasks poll the queues, stop them first
+    for name in info.get('service', []):
+        _delete_service(name)
+
     for sqs in info['sqs']:
         _delete_queue(sqs)
 
@@ -55,6 +107,13 @@ def main():
         _deleta_lambda(lambda_arn)
         _delete_lambda_log(lambda_arn)
 
+    for name in info.get('capacity', []):
+        _release_capacity(name)
+
+    if 'scheduler_events' in info:
+        _delete_scheduler_events(info['scheduler_events']['rule'],
+                                 info['scheduler_events']['queue'])
+
     # for s3 in info['s3']:
     #     _delete_s3(s3)
 
@@ -84,4 +143,5 @@ def main():
                 print(msgs)
                 raise
 
+    remove_all_manifests()
     print('Successfully clean up everything')
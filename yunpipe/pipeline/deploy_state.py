@@ -0,0 +1,231 @@
+'''
+deployed state of each pipeline, kept as a manifest in
+~/.cloud_pipe/pipelines/name.json, and the plan of the changes setup-pipe
+makes to bring a pipeline to a new user request.
+
+A stage is kept as deployed while its spec, a digest of everything its
+task definition and lambda function (or service) are made of, is
+unchanged. A changed stage gets a new task definition and lambda function
+or service on its existing queue, and a removed stage is deleted.
+'''
+import json
+import os
+from glob import glob
+from hashlib import sha256
+
+from .. import CLOUD_PIPE_PIPELINE_FOLDER
+
+# work flow settings every stage is made with
+WORKFLOW_KEYS = ['key_pair', 'account_id', 'region', 'capacity', 'scheduler',
+                 'lambda', 'cluster_state']
+
+# estimated api calls of each setup step, see estimate_calls()
+API_CALLS = {
+    'sys_info': 2,
+    'alarm': 2,
+    'role': 2,
+    'state_table': 1,
+    'capacity_provider': 6,
+    'cluster_providers': 3,
+    'bucket': 2,
+    'queue': 2,
+    'task': 1,
+    'lambda': 3,
+    'service': 4,
+    'event': 3,
+    'delete_task': 1,
+    'delete_lambda': 1,
+    'delete_service': 3,
+    'delete_queue': 1,
+    'unhook': 1,
+}
+
+
+def get_pipeline_name(user_request):
+    '''
+    rtype: string, "name" of the work flow, its input bucket if not set
+    '''
+    return user_request.get('name') or user_request['input_s3_name']
+
+
+def _manifest_path(name):
+    return os.path.join(CLOUD_PIPE_PIPELINE_FOLDER, name + '.json')
+
+
+def load_manifest(name):
+    '''
+    rtype: dict, deployed state of pipeline name, None if never deployed
+    '''
+    try:
+        with open(_manifest_path(name), 'r') as data_file:
+            return json.load(data_file)
+    except IOError:
+        return None
+
+
+def save_manifest(name, manifest):
+    tmp_path = _manifest_path(name) + '.tmp'
+    with open(tmp_path, 'w') as data_file:
+        json.dump(manifest, data_file, indent='    ', sort_keys=True)
+    os.replace(tmp_path, _manifest_path(name))
+
+
+def load_all_manifests():
+    '''
+    rtype: list, deployed state of every pipeline
+    '''
+    manifests = []
+    for file_path in sorted(glob(os.path.join(CLOUD_PIPE_PIPELINE_FOLDER,
+                                              '*.json'))):
+        with open(file_path, 'r') as data_file:
+            manifests.append(json.load(data_file))
+    return manifests
+
+
+def remove_all_manifests():
+    for file_path in glob(os.path.join(CLOUD_PIPE_PIPELINE_FOLDER, '*.json')):
+        os.remove(file_path)
+
+
+def stage_spec(request, algorithm_info, workflow, credentials):
+    '''
+    digest of everything a stage is made of: its algorithm entry, buckets,
+    algorithm info, work flow settings and task credentials
+
+    rtype: string
+    '''
+    spec = {'request': {key: value for key, value in request.items()
+                        if key != 'sqs'},
+            'algorithm': algorithm_info,
+            'workflow': workflow,
+            'credentials': credentials}
+    return sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def diff_stages(specs, deployed):
+    '''
+    compare the spec of each wanted stage with the deployed stages, by
+    position in the pipeline
+
+    para: specs: spec of each wanted stage, see stage_spec()
+    type: list
+
+    para: deployed: stages of the manifest
+    type: list
+
+    rtype: list of tuple, (action, index), action one of 'create',
+    'replace', 'keep' and 'delete'
+    '''
+    changes = []
+    for i, spec in enumerate(specs):
+        if i >= len(deployed):
+            changes.append(('create', i))
+        elif deployed[i]['spec'] != spec:
+            changes.append(('replace', i))
+        else:
+            changes.append(('keep', i))
+    for i in range(len(specs), len(deployed)):
+        changes.append(('delete', i))
+    return changes
+
+
+def stage_resources(stage):
+    '''
+    rtype: list, names of the resources a stage in mode (task or service)
+    is made of, see API_CALLS
+    '''
+    resources = ['task']
+    if stage.get('mode', 'task') == 'service':
+        resources.append('service')
+    elif not stage.get('scheduler'):
+        resources.append('lambda')
+    return resources
+
+
+def estimate_calls(changes, wanted, deployed, new_buckets, unhook, shared):
+    '''
+    estimate the api calls to apply changes, counting lookups that may be
+    skipped
+
+    para: wanted: mode and scheduler of each wanted stage
+    type: list of dict
+
+    para: shared: shared resources set up, names of API_CALLS
+    type: list
+
+    rtype: int
+    '''
+    calls = sum(API_CALLS[name] for name in shared)
+    calls += API_CALLS['bucket'] * len(new_buckets)
+    calls += API_CALLS['unhook'] * len(unhook)
+    for action, i in changes:
+        if action in ('create', 'replace'):
+            if action == 'create':
+                calls += API_CALLS['queue']
+            calls += sum(API_CALLS[name] for name in
+                         stage_resources(wanted[i]))
+            calls += API_CALLS['event']
+        if action in ('replace', 'delete'):
+            calls += sum(API_CALLS['delete_' + name] for name in
+                         stage_resources(deployed[i]))
+        if action == 'delete':
+            calls += API_CALLS['delete_queue']
+    return calls
+
+
+def format_plan(name, changes, wanted, deployed, new_buckets, unhook,
+                calls):
+    '''
+    rtype: string, the changes of pipeline name for people to read
+    '''
+    names = {'task': 'task definition', 'lambda': 'lambda function',
+             'service': 'ecs service'}
+    lines = ['pipeline {}:'.format(name)]
+    for bucket in new_buckets:
+        lines.append('  + s3 bucket {}'.format(bucket))
+    for action, i in changes:
+        if action == 'create':
+            parts = ['queue'] + [names[r] for r in
+                                 stage_resources(wanted[i])]
+            lines.append('  + stage {} {}: {}'.format(
+                i, wanted[i]['name'], ', '.join(parts)))
+        elif action == 'replace':
+            parts = [names[r] for r in stage_resources(wanted[i])]
+            lines.append('  ~ stage {} {}: new {}, queue kept'.format(
+                i, wanted[i]['name'], ', '.join(parts)))
+        elif action == 'keep':
+            lines.append('  = stage {} {}'.format(i, wanted[i]['name']))
+        else:
+            parts = [names[r] for r in
+                     stage_resources(deployed[i])] + ['queue']
+            lines.append('  - stage {} {}: {}'.format(
+                i, deployed[i]['name'], ', '.join(parts)))
+    for bucket in unhook:
+        lines.append('  - s3 bucket {} event notification'.format(bucket))
+    if calls:
+        lines.append('estimated api calls: {}'.format(calls))
+    else:
+        lines.append('no changes')
+    return '\n'.join(lines)
+
+
+def collect_resources(manifests):
+    '''
+    resources of every deployed pipeline in the format of clean_up.json
+
+    rtype: dict
+    '''
+    clean = {'sqs': [], 'task': [], 'lambda': [], 'service': [], 's3': [],
+             'capacity': [], 'cloudwatch': None}
+    for manifest in manifests:
+        clean['cloudwatch'] = manifest['shared'].get('alarm') or \
+            clean['cloudwatch']
+        clean['capacity'].extend(
+            manifest['shared'].get('capacity', {}).values())
+        clean['s3'].extend(manifest['buckets'])
+        for stage in manifest['stages']:
+            clean['sqs'].append(stage['sqs'])
+            for kind in ('task', 'lambda', 'service'):
+                clean[kind].extend(stage['resources'][kind])
+    clean['capacity'] = sorted(set(clean['capacity']))
+    return clean
@@ -1,14 +1,19 @@
 import json
 import os.path
+from hashlib import sha256
 
 from haikunator import Haikunator
 
 from .. import CLOUD_PIPE_TEMPLATES_FOLDER
+from ..wrapper.container_wrapper import RUNSCRIPT_VARIABLES
 
 name_generator = Haikunator()
 
 # TODO: add instance_type
 
+# variables set by yunpipe rather than the algorithm user
+SYSTEM_VARIABLES = {'output_s3_name', 'sqs', 'NAME', 'LOG_LVL'}
+
 
 class image:
     class port_class:
@@ -51,9 +56,33 @@ class image:
         self.memory = info['memory']['suggested']
         self.name = info['name']
         self.image = info['container_name']
-        self.instance_type = info['instance_type']
-        # TODO: this need to be changed
-        self.cpu = 32
+        # acceptable instance types in order of preference, the next one is
+        # used when the previous has no capacity
+        self.instance_types = info.get('instance_types') or \
+            [info['instance_type']]
+        self.instance_type = self.instance_types[0]
+        # cpu units from number of CPUs, profile-algorithm suggests it
+        cpu = info.get('CPU')
+        if isinstance(cpu, (int, float)) and cpu > 0:
+            self.cpu = int(cpu * 1024)
+        else:
+            self.cpu = 32
+        # number of files processed concurrently in one task
+        self.workers = 1
+        # multipart chunk_size (MB) and max_concurrency of S3 transfers,
+        # auto tuned by runscript if not set
+        self.transfer = dict(info.get('transfer', {}))
+        # reuse results of the same input, can be turned off per algorithm
+        self.result_cache = info.get('result_cache', True)
+        self.variables_digest = ''
+        # format (zip, tar or tar.zst) and compression level of folder results
+        self.archive = dict(info.get('archive', {}))
+        # files gathered (size) and seconds waited (wait) for one run in
+        # $inputs batch mode
+        self.batch = dict(info.get('batch', {}))
+        # task started for files (task) or kept running by an ecs service
+        self.mode = 'task'
+
         self.port = {}
         self.env_variable = {}
 
@@ -69,6 +98,21 @@ class image:
         para info:
         type: json
         '''
+        self.workers = info.get('workers', 1)
+        self.transfer.update(info.get('transfer', {}))
+        self.result_cache = info.get('result_cache', self.result_cache)
+        self.archive.update(info.get('archive', {}))
+        self.batch.update(info.get('batch', {}))
+        self.mode = info.get('mode', self.mode)
+
+        # runscript tuning does not change results
+        user_variables = {name: value for name, value in
+                          info['variables'].items()
+                          if name not in SYSTEM_VARIABLES and
+                          name not in RUNSCRIPT_VARIABLES}
+        self.variables_digest = sha256(json.dumps(
+            user_variables, sort_keys=True).encode()).hexdigest()
+
         for port_number in info['port']:
             self.port[port_number].add_default_port_mapping()
 
@@ -103,6 +147,63 @@ class image:
         helper['required'] = True
         self.env_variable[var_name] = self.variable(helper)
 
+    def get_task_memory(self):
+        '''
+        memory of one task, enough for every worker to run the algorithm
+
+        rtype: int
+        '''
+        return self.memory * self.workers
+
+    def get_task_cpu(self):
+        '''
+        cpu units of one task
+
+        rtype: int
+        '''
+        return self.cpu * self.workers
+
+    def get_task_environment(self):
+        '''
+        environment variables describing task resources for runscript to size
+        its worker pool and S3 transfers, and identifying the algorithm run
+        for the result cache
+
+        rtype: list
+        '''
+        env = []
+        env.append({'name': 'TASK_CPU', 'value': str(self.get_task_cpu())})
+        env.append({'name': 'TASK_MEMORY',
+                    'value': str(self.get_task_memory())})
+        env.append({'name': 'FILE_CPU', 'value': str(self.cpu)})
+        env.append({'name': 'FILE_MEMORY', 'value': str(self.memory)})
+        env.append({'name': 'INSTANCE_TYPE', 'value': self.instance_type})
+        env.append({'name': 'RESULT_CACHE', 'value': str(self.result_cache)})
+        env.append({'name': 'ALGORITHM_IMAGE', 'value': self.image})
+        env.append({'name': 'ALGORITHM_VARIABLES',
+                    'value': self.variables_digest})
+        if 'format' in self.archive:
+            env.append({'name': 'ARCHIVE_FORMAT',
+                        'value': self.archive['format']})
+        if 'level' in self.archive:
+            env.append({'name': 'ARCHIVE_LEVEL',
+                        'value': str(self.archive['level'])})
+        if 'size' in self.batch:
+            env.append({'name': 'BATCH_SIZE',
+                        'value': str(self.batch['size'])})
+        if 'wait' in self.batch:
+            env.append({'name': 'BATCH_WAIT',
+                        'value': str(self.batch['wait'])})
+        if 'chunk_size' in self.transfer:
+            env.append({'name': 'S3_CHUNK_SIZE',
+                        'value': str(self.transfer['chunk_size'])})
+        if 'max_concurrency' in self.transfer:
+            env.append({'name': 'S3_MAX_CONCURRENCY',
+                        'value': str(self.transfer['max_concurrency'])})
+        if self.mode == 'service':
+            env.append({'name': 'SERVICE_MODE', 'value': 'True'})
+        return env
+
     def generate_task(self):
         '''
         generate task definition from template
@@ -114,12 +215,12 @@ class image:
 
         template['family'] = self.name + name_generator.haikunate()
 
-        template['containerDefinitions'][0]['memory'] = self.memory
+        template['containerDefinitions'][0]['memory'] = self.get_task_memory()
         template['containerDefinitions'][0]['name'] = self.name + \
             name_generator.haikunate()
         template['containerDefinitions'][0]['image'] = self.image
         # TODO: change 32
-        template['containerDefinitions'][0]['cpu'] = 32
+        template['containerDefinitions'][0]['cpu'] = self.get_task_cpu()
 
         # add port
         for port in self.port.values():
@@ -141,6 +242,9 @@ class image:
                 template['containerDefinitions'][0]['environment'].append(
                     {'name': var.name, 'value': var.value})
 
+        template['containerDefinitions'][0]['environment'].extend(
+            self.get_task_environment())
+
         if len(template['containerDefinitions'][0]['environment']) == 0:
             del template['containerDefinitions'][0]['environment']
 
@@ -0,0 +1,59 @@
+'''
+local registry of the aws resources yunpipe created, kept in
+~/.cloud_pipe/registry.json, so setting up a pipeline again finds them
+without asking aws. clean-up forgets the resources it deletes; delete the
+file to look every resource up again.
+'''
+import json
+import os
+from threading import Lock
+
+from .. import CLOUD_PIPE_REGISTRY
+
+
+class resource_registry:
+    '''
+    identifier (such as queue url) of each resource by kind and name,
+    shared by setup threads
+    '''
+
+    def __init__(self, file_path=CLOUD_PIPE_REGISTRY):
+        self.file_path = file_path
+        self.lock = Lock()
+        try:
+            with open(file_path, 'r') as data_file:
+                self.resources = json.load(data_file)
+        except (IOError, ValueError):
+            self.resources = {}
+
+    def get(self, kind, name):
+        '''
+        rtype: string, None if not registered
+        '''
+        with self.lock:
+            return self.resources.get(kind, {}).get(name)
+
+    def add(self, kind, name, value):
+        with self.lock:
+            self.resources.setdefault(kind, {})[name] = value
+            self._save()
+
+    def forget(self, kind, value):
+        '''
+        remove every resource of kind registered with value
+        '''
+        with self.lock:
+            entries = self.resources.get(kind, {})
+            for name in [n for n, v in entries.items() if v == value]:
+                del entries[name]
+            self._save()
+
+    def _save(self):
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w') as data_file:
+            json.dump(self.resources, data_file, indent='    ',
+                      sort_keys=True)
+        os.replace(tmp_path, self.file_path)
+
+
+registry = resource_registry()
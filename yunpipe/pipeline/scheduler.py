@@ -0,0 +1,499 @@
+'''
+long running scheduler starting the ecs tasks of every pipeline stage in
+place of the lambda functions.
+
+It keeps a model of the container instances and tasks of the cluster in
+memory. The model is built once from list/describe calls and then updated
+by the ECS task and container instance state change events EventBridge puts
+into EVENT_QUEUE, with a full refresh every RESYNC_INTERVAL seconds to
+correct any drift. Each tick reads the backlog of every stage queue and
+places all tasks needed in one batch against the model.
+'''
+import json
+import math
+from time import time
+from time import sleep
+
+from botocore.exceptions import ClientError
+
+from . import session
+
+# seconds between placement rounds and between full model refreshes
+TICK = 1
+RESYNC_INTERVAL = 300
+
+EVENT_QUEUE = 'yunpipe-scheduler-events'
+EVENT_RULE = 'yunpipe-scheduler'
+# most event batches read in one tick
+MAX_EVENT_BATCHES = 100
+
+# API limits of describe calls, start_task and run_task
+DESCRIBE_LIMIT = 100
+START_TASK_LIMIT = 10
+RUN_TASK_LIMIT = 10
+
+# launch errors after which the next instance type is tried
+CAPACITY_ERRORS = {'InsufficientInstanceCapacity', 'InstanceLimitExceeded',
+                   'Unsupported'}
+# memory of an instance type not registered with ECS, for the agent and os
+INSTANCE_OVERHEAD = 0.1
+# seconds an instance launched for a shortfall is waited to join
+LAUNCH_TIMEOUT = 600
+
+
+def get_resources(resources):
+    '''
+    rtype: tuple, CPU units and MEMORY in MB of a list of ecs resources
+    '''
+    values = {r['name']: r.get('integerValue', 0) for r in resources}
+    return values.get('CPU', 0), values.get('MEMORY', 0)
+
+
+def get_family(task_definition_arn):
+    '''
+    rtype: string, family of a task definition arn
+    '''
+    return task_definition_arn.split('/')[-1].split(':')[0]
+
+
+class cluster_model:
+    '''
+    container instances and tasks of one ecs cluster, each kept with the
+    version of the ECS event last applied so late events are ignored
+    '''
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.instances = {}
+        self.tasks = {}
+
+    def refresh(self, ecs):
+        '''
+        rebuild the model with list and describe calls, describing at most
+        DESCRIBE_LIMIT resources at a time
+        '''
+        arns = []
+        paginator = ecs.get_paginator('list_container_instances')
+        for page in paginator.paginate(cluster=self.cluster,
+                                       status='ACTIVE'):
+            arns.extend(page['containerInstanceArns'])
+        instances = {}
+        for i in range(0, len(arns), DESCRIBE_LIMIT):
+            for item in ecs.describe_container_instances(
+                    cluster=self.cluster,
+                    containerInstances=arns[i:i + DESCRIBE_LIMIT]
+            )['containerInstances']:
+                instances[item['containerInstanceArn']] = \
+                    self._instance(item)
+
+        arns = []
+        paginator = ecs.get_paginator('list_tasks')
+        for page in paginator.paginate(cluster=self.cluster,
+                                       desiredStatus='RUNNING'):
+            arns.extend(page['taskArns'])
+        tasks = {}
+        for i in range(0, len(arns), DESCRIBE_LIMIT):
+            for item in ecs.describe_tasks(
+                    cluster=self.cluster,
+                    tasks=arns[i:i + DESCRIBE_LIMIT])['tasks']:
+                tasks[item['taskArn']] = self._task(item)
+
+        self.instances = instances
+        self.tasks = tasks
+
+    def _instance(self, item):
+        attributes = {a['name']: a.get('value')
+                      for a in item.get('attributes', [])}
+        cpu, memory = get_resources(item['remainingResources'])
+        total_cpu, total_memory = get_resources(item['registeredResources'])
+        return {'arn': item['containerInstanceArn'],
+                'ec2': item.get('ec2InstanceId'),
+                'type': attributes.get('ecs.instance-type'),
+                'status': item.get('status', 'ACTIVE'),
+                'connected': item.get('agentConnected', True),
+                'cpu': cpu, 'memory': memory,
+                'total_cpu': total_cpu, 'total_memory': total_memory,
+                'version': item.get('version', 0)}
+
+    def _task(self, item):
+        return {'arn': item['taskArn'],
+                'family': get_family(item['taskDefinitionArn']),
+                'instance': item.get('containerInstanceArn'),
+                'status': item.get('lastStatus'),
+                'desired': item.get('desiredStatus'),
+                'version': item.get('version', 0)}
+
+    def add_task(self, item):
+        '''
+        add a task just started, as described by start_task or run_task
+        '''
+        self.tasks[item['taskArn']] = self._task(item)
+
+    def apply_event(self, event):
+        '''
+        update the model from one ECS state change event
+
+        para: event: EventBridge event
+        type: dict
+        '''
+        detail = event.get('detail', {})
+        if event.get('detail-type') == 'ECS Container Instance State Change':
+            item = self._instance(detail)
+            old = self.instances.get(item['arn'])
+            if old is not None and old['version'] > item['version']:
+                return
+            if item['status'] in ('INACTIVE', 'DEREGISTERING'):
+                self.instances.pop(item['arn'], None)
+            else:
+                self.instances[item['arn']] = item
+        elif event.get('detail-type') == 'ECS Task State Change':
+            item = self._task(detail)
+            old = self.tasks.get(item['arn'])
+            if old is not None and old['version'] > item['version']:
+                return
+            if item['status'] == 'STOPPED':
+                self.tasks.pop(item['arn'], None)
+            else:
+                self.tasks[item['arn']] = item
+
+    def running(self, family):
+        '''
+        rtype: int, tasks of family running or about to run
+        '''
+        return sum(1 for t in self.tasks.values()
+                   if t['family'] == family and t['desired'] == 'RUNNING')
+
+    def reserve(self, arn, cpu, memory):
+        '''
+        take the resources of a task placed on instance arn before ECS
+        reports it
+        '''
+        self.instances[arn]['cpu'] -= cpu
+        self.instances[arn]['memory'] -= memory
+
+    def choose_instance(self, instance_types, cpu, memory, strategy):
+        '''
+        choose the container instance of instance_types to place a task by
+        strategy: bestfit leaves the least CPU and memory unused, relative to
+        the instance size; binpack the least memory; spread the most memory.
+
+        rtype: dict, None if no instance has enough resources
+        '''
+        best = None
+        best_score = None
+        for instance in self.instances.values():
+            if instance['type'] not in instance_types or \
+                    not instance['connected']:
+                continue
+            left_cpu = instance['cpu'] - cpu
+            left_memory = instance['memory'] - memory
+            if left_cpu < 0 or left_memory < 0:
+                continue
+
+            if strategy == 'spread':
+                score = -left_memory
+            elif strategy == 'binpack':
+                score = left_memory
+            else:
+                score = left_cpu / max(instance['total_cpu'], 1) + \
+                    left_memory / max(instance['total_memory'], 1)
+            if best is None or score < best_score:
+                best = instance
+                best_score = score
+        return best
+
+
+class scheduler:
+    '''
+    starts the tasks of every stage in config each tick, in proportion to
+    the backlog of its queue
+    '''
+
+    def __init__(self, config):
+        '''
+        para: config: cluster, launch settings and stages written by
+        setup-pipe, see set_pipe.main()
+        type: dict
+        '''
+        self.config = config
+        self.stages = config['stages']
+        self.ecs = session.client('ecs')
+        self.sqs = session.client('sqs')
+        self.ec2 = session.client('ec2')
+        self.model = cluster_model(config['cluster'])
+        self.event_queue = None
+        self.synced = 0
+        # launch time of instances not yet joined the cluster
+        self.launched = {}
+        self.instance_sizes = {}
+
+    def setup_events(self):
+        '''
+        route ECS state change events of the cluster into EVENT_QUEUE
+        '''
+        self.event_queue = self.sqs.create_queue(
+            QueueName=EVENT_QUEUE)['QueueUrl']
+        queue_arn = self.sqs.get_queue_attributes(
+            QueueUrl=self.event_queue,
+            AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+        cluster_arn = self.ecs.describe_clusters(
+            clusters=[self.config['cluster']])['clusters'][0]['clusterArn']
+
+        events = session.client('events')
+        rule_arn = events.put_rule(
+            Name=EVENT_RULE,
+            EventPattern=json.dumps({
+                'source': ['aws.ecs'],
+                'detail-type': ['ECS Task State Change',
+                                'ECS Container Instance State Change'],
+                'detail': {'clusterArn': [cluster_arn]}}))['RuleArn']
+        events.put_targets(Rule=EVENT_RULE,
+                           Targets=[{'Id': EVENT_QUEUE, 'Arn': queue_arn}])
+
+        policy = {
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Principal': {'Service': 'events.amazonaws.com'},
+                'Action': 'sqs:SendMessage',
+                'Resource': queue_arn,
+                'Condition': {'ArnEquals': {'aws:SourceArn': rule_arn}}}]}
+        self.sqs.set_queue_attributes(
+            QueueUrl=self.event_queue,
+            Attributes={'Policy': json.dumps(policy)})
+
+    def read_events(self):
+        '''
+        apply the events waiting in EVENT_QUEUE to the model
+
+        rtype: int, number of events applied
+        '''
+        count = 0
+        for _ in range(MAX_EVENT_BATCHES):
+            msgs = self.sqs.receive_message(
+                QueueUrl=self.event_queue,
+                MaxNumberOfMessages=10).get('Messages', [])
+            if not msgs:
+                break
+            for msg in msgs:
+                try:
+                    self.model.apply_event(json.loads(msg['Body']))
+                    count += 1
+                except (ValueError, KeyError) as err:
+                    print('drop unknown event: {}'.format(err))
+            self.sqs.delete_message_batch(
+                QueueUrl=self.event_queue,
+                Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']}
+                         for i, m in enumerate(msgs)])
+        return count
+
+    def get_backlog(self, stage):
+        '''
+        rtype: int, approximate number of files waiting or in process on the
+        queue of stage
+        '''
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=stage['sqs'],
+            AttributeNames=['ApproximateNumberOfMessages',
+                            'ApproximateNumberOfMessagesNotVisible']
+        )['Attributes']
+        return int(attributes['ApproximateNumberOfMessages']) + \
+            int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+    def tasks_needed(self, stage):
+        '''
+        rtype: int, tasks to start for the backlog of stage, capped by its
+        max_tasks
+        '''
+        backlog = self.get_backlog(stage)
+        if backlog == 0:
+            return 0
+        wanted = min(stage['max_tasks'], int(math.ceil(
+            backlog / stage['files_per_task'])))
+        return max(0, wanted - self.model.running(stage['task']))
+
+    def place(self, stage, count):
+        '''
+        place count tasks of stage on the model, taking their resources
+
+        rtype: list, container instance arn of each task placed
+        '''
+        plan = []
+        for _ in range(count):
+            instance = self.model.choose_instance(
+                stage['instance_types'], stage['cpu'], stage['memory'],
+                stage['placement'])
+            if instance is None:
+                break
+            self.model.reserve(instance['arn'], stage['cpu'],
+                               stage['memory'])
+            plan.append(instance['arn'])
+        return plan
+
+    def start_tasks(self, stage, plan):
+        '''
+        start tasks of stage on the planned container instances, one task on
+        each of up to START_TASK_LIMIT instances per call
+
+        rtype: int, number of tasks started
+        '''
+        started = 0
+        plan = list(plan)
+        while plan:
+            batch = []
+            for arn in plan:
+                if arn not in batch and len(batch) < START_TASK_LIMIT:
+                    batch.append(arn)
+            for arn in batch:
+                plan.remove(arn)
+            res = self.ecs.start_task(cluster=self.config['cluster'],
+                                      taskDefinition=stage['task'],
+                                      containerInstances=batch)
+            started += len(res['tasks'])
+            for task in res['tasks']:
+                self.model.add_task(task)
+            if res['failures']:
+                print('failed to start {}: {}'.format(
+                    stage['name'], [f.get('reason') for f in res['failures']]))
+                failed = [f.get('arn') for f in res['failures']]
+                plan = [arn for arn in plan if arn not in failed]
+        return started
+
+    def start_provisioned_tasks(self, stage, count):
+        '''
+        run count tasks of stage on its capacity provider, ECS keeps them in
+        PROVISIONING until managed scaling adds instances
+
+        rtype: int, number of tasks started
+        '''
+        started = 0
+        while started < count:
+            res = self.ecs.run_task(
+                cluster=self.config['cluster'], taskDefinition=stage['task'],
+                count=min(RUN_TASK_LIMIT, count - started),
+                capacityProviderStrategy=[{
+                    'capacityProvider': stage['capacity_provider'],
+                    'weight': 1}])
+            started += len(res['tasks'])
+            for task in res['tasks']:
+                self.model.add_task(task)
+            if res['failures']:
+                print('failed to run {}: {}'.format(
+                    stage['name'], [f.get('reason') for f in res['failures']]))
+                break
+        return started
+
+    def get_instance_size(self, instance_type):
+        '''
+        rtype: tuple, CPU units and MB of memory tasks can use on
+        instance_type
+        '''
+        if instance_type not in self.instance_sizes:
+            info = self.ec2.describe_instance_types(
+                InstanceTypes=[instance_type])['InstanceTypes'][0]
+            memory = info['MemoryInfo']['SizeInMiB'] * (1 - INSTANCE_OVERHEAD)
+            self.instance_sizes[instance_type] = (
+                info['VCpuInfo']['DefaultVCpus'] * 1024, int(memory))
+        return self.instance_sizes[instance_type]
+
+    def launch_instances(self, stage, count):
+        '''
+        launch instances holding count tasks of stage, trying its instance
+        types in order until one has capacity
+
+        rtype: list, launched instance ids
+        '''
+        launch = self.config['launch']
+        for instance_type in stage['instance_types']:
+            cpu, memory = self.get_instance_size(instance_type)
+            per_instance = max(1, min(cpu // max(stage['cpu'], 1),
+                                      memory // stage['memory']))
+            try:
+                res = self.ec2.run_instances(
+                    ImageId=launch['image_id'], KeyName=launch['key_pair'],
+                    InstanceType=instance_type, SubnetId=launch['subnet_id'],
+                    IamInstanceProfile={'Name': launch['iam_name']},
+                    MinCount=1,
+                    MaxCount=int(math.ceil(count / per_instance)))
+            except ClientError as err:
+                if err.response['Error']['Code'] not in CAPACITY_ERRORS:
+                    raise
+                print('no capacity of {}: {}'.format(instance_type, err))
+                continue
+            ids = [i['InstanceId'] for i in res['Instances']]
+            print('launch {} {} instances for {}'.format(
+                len(ids), instance_type, stage['name']))
+            self.register_shutdown(ids)
+            return ids
+        return []
+
+    def register_shutdown(self, instance_ids):
+        '''
+        terminate idle launched instances by cloudwatch alarms, sent to the
+        alarm queue for clean up
+        '''
+        launch = self.config['launch']
+        cw = session.client('cloudwatch')
+        for instance_id in instance_ids:
+            alarm_name = instance_id + '-shutdown'
+            cw.put_metric_alarm(
+                AlarmName=alarm_name,
+                AlarmActions=['arn:aws:swf:{}:{}:action/actions/AWS_EC2.InstanceId.Terminate/1.0'.format(launch['region'], launch['account_id'])],
+                MetricName='CPUUtilization', Namespace='AWS/EC2',
+                Statistic='Average',
+                Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
+                Period=300, EvaluationPeriods=2, Threshold=1,
+                ComparisonOperator='LessThanThreshold')
+            self.sqs.send_message(
+                QueueUrl=launch['alarm_sqs'],
+                MessageBody=json.dumps({'alarm_name': alarm_name,
+                                        'ec2InstanceId': instance_id}))
+
+    def tick(self):
+        '''
+        one scheduling round: update the model, then start the tasks every
+        stage needs
+        '''
+        if self.event_queue is not None:
+            self.read_events()
+        if time() - self.synced > RESYNC_INTERVAL:
+            self.model.refresh(self.ecs)
+            self.synced = time()
+
+        now = time()
+        joined = {i['ec2'] for i in self.model.instances.values()}
+        for instance_id, launch_time in list(self.launched.items()):
+            if instance_id in joined or now - launch_time > LAUNCH_TIMEOUT:
+                del self.launched[instance_id]
+
+        for stage in self.stages:
+            if stage.get('mode') == 'service':
+                # the ecs service scales itself
+                continue
+            count = self.tasks_needed(stage)
+            if count == 0:
+                continue
+            started = self.start_tasks(stage, self.place(stage, count))
+            if started < count and stage.get('capacity_provider'):
+                started += self.start_provisioned_tasks(stage,
+                                                        count - started)
+            elif started < count and not self.launched:
+                for instance_id in self.launch_instances(stage,
+                                                         count - started):
+                    self.launched[instance_id] = now
+            print('{}: started {} of {} tasks'.format(stage['name'], started,
+                                                      count))
+
+    def run(self, tick=TICK):
+        '''
+        schedule every tick seconds until interrupted
+        '''
+        self.setup_events()
+        while True:
+            start = time()
+            # a failed tick is retried the next one, scaling never stops
+            try:
+                self.tick()
+            except Exception as err:
+                print('tick failed: {!r}'.format(err))
+            sleep(max(0, tick - (time() - start)))
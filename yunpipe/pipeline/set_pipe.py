@@ -1,7 +1,16 @@
 import json
 from zipfile import ZipFile
+from zipfile import ZipInfo
+from base64 import b64encode
+from base64 import b64decode
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+from threading import Lock
+from time import localtime
+from fnmatch import fnmatchcase
 
 from botocore.exceptions import ClientError
 from haikunator import Haikunator
@@ -9,6 +18,20 @@ from haikunator import Haikunator
 from .image_class import image
 from .task_config import get_task_credentials
 from . import session
+from .registry import registry
+from .scheduler import EVENT_QUEUE
+from .scheduler import EVENT_RULE
+from .deploy_state import WORKFLOW_KEYS
+from .deploy_state import get_pipeline_name
+from .deploy_state import load_manifest
+from .deploy_state import save_manifest
+from .deploy_state import load_all_manifests
+from .deploy_state import stage_spec
+from .deploy_state import diff_stages
+from .deploy_state import stage_resources
+from .deploy_state import estimate_calls
+from .deploy_state import format_plan
+from .deploy_state import collect_resources
 from .. import CLOUD_PIPE_ALGORITHM_FOLDER
 from .. import CLOUD_PIPE_TMP_FOLDER
 from .. import CLOUD_PIPE_TEMPLATES_FOLDER
@@ -18,10 +41,41 @@ WAIT_TIME = 5
 
 name_generator = Haikunator()
 
-LAMBDA_EXEC_TIME = 300
+# runtime, memory in MB and timeout in seconds of the lambda functions,
+# overridden by "lambda" of the work flow and of each algorithm. Lambda
+# gives CPU in proportion to memory, so memory also sets the cold start.
+DEFAULT_LAMBDA = {'runtime': 'python3.12', 'memory': 512, 'timeout': 300}
 
 LAMBDA_EXEC_ROLE_NAME = 'lambda_exec_role'
 
+# warm instances kept, most instances and target reservation percent of the
+# capacity pool of each instance type, see setup_capacity()
+DEFAULT_CAPACITY = {'min_size': 0, 'max_size': 10, 'target_capacity': 100}
+
+ECS_CLUSTER = 'default'
+
+# DynamoDB table of the cluster snapshot the lambda functions share
+STATE_TABLE = 'yunpipe-cluster-state'
+
+# seconds between scaling activities of the ecs service of a stage in
+# service mode, and the most task counts its policy steps through, see
+# _scale_service()
+SERVICE_SCALE_COOLDOWN = 60
+MAX_SCALING_STEPS = 20
+
+# stages started by yunpipe-scheduler, under CLOUD_PIPE_TMP_FOLDER
+SCHEDULER_CONFIG = 'scheduler.json'
+ECS_AMI_PARAMETER = \
+    '/aws/service/ecs/optimized-ami/amazon-linux-2/recommended/image_id'
+
+# threads setting up the resources of a work flow, see _run_steps()
+SETUP_WORKERS = 8
+
+# boto3 clients are thread safe, creating them from one session is not,
+# see _client()
+clients = {}
+client_lock = Lock()
+
 LAMBDA_EXEC_ROLE = {
     "Statement": [
         {
@@ -30,10 +84,18 @@ LAMBDA_EXEC_ROLE = {
                 "cloudwatch:*",
                 "lambda:invokeFunction",
                 "sqs:SendMessage",
+                "sqs:GetQueueAttributes",
                 "ec2:Describe*",
-                "ec2:StartInsatnces",
+                "ec2:StartInstances",
+                "ec2:RunInstances",
                 "iam:PassRole",
-                "ecs:RunTask"
+                "ecs:RunTask",
+                "ecs:StartTask",
+                "ecs:ListTasks",
+                "ecs:ListContainerInstances",
+                "ecs:DescribeContainerInstances",
+                "dynamodb:GetItem",
+                "dynamodb:PutItem"
             ],
             "Effect": "Allow",
             "Resource": [
@@ -42,7 +104,9 @@ LAMBDA_EXEC_ROLE = {
                 "arn:aws:sqs:*:*:*",
                 "arn:aws:ec2:*:*:*",
                 "arn:aws:cloudwatch:*:*:*",
-                "arn:aws:ecs:*:*:*"
+                "arn:aws:ecs:*:*:*",
+                "arn:aws:iam::*:role/*",
+                "arn:aws:dynamodb:*:*:table/yunpipe-cluster-state"
             ]
         }
     ],
@@ -65,6 +129,47 @@ LAMBDA_EXECUTION_ROLE_TRUST_POLICY = {
 }
 
 
+# clients and setup steps
+
+def _client(name):
+    '''
+    rtype: the boto3 client of service name, shared by setup threads
+    '''
+    with client_lock:
+        if name not in clients:
+            clients[name] = session.client(name)
+        return clients[name]
+
+
+def _run_steps(steps, workers=SETUP_WORKERS):
+    '''
+    run setup steps on a pool of workers threads, each step as soon as the
+    steps it depends on are done
+
+    para: steps: name of each step and its function and the names of the
+    steps it depends on. The function is called with the results so far.
+    type: dict, {name: (function, [name])}
+
+    rtype: dict, result of each step
+    '''
+    results = {}
+    pending = dict(steps)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    running[pool.submit(func, results)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError('setup steps {} wait for missing steps'.format(
+                    sorted(pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
 # SQS related
 
 
@@ -72,33 +177,37 @@ def _get_or_create_queue(name):
     '''
     get queue by name, if the queue doesnot exist, create one.
 
-    rtype: string
+    rtype: string, queue url
     '''
-
-    resource = session.resource('sqs')
-    if _is_sqs_exist(name):
-        return resource.get_queue_by_name(QueueName=name).url
-    else:
-        return resource.create_queue(QueueName=name).url
+    key = session.region_name + '/' + name
+    url = registry.get('sqs', key) or _get_queue_url(name)
+    if url is None:
+        url = _client('sqs').create_queue(QueueName=name)['QueueUrl']
+    registry.add('sqs', key, url)
+    return url
 
 
-def _is_sqs_exist(name):
+def _get_queue_url(name):
     '''
-    check existense of a given queue
+    look up a given queue
     para: name: sqs name
     type: string
+
+    rtype: string, None if the queue does not exist
     '''
-    queues = session.client('sqs').list_queues()
-    if 'QueueUrls' in queues:
-        for queue in queues['QueueUrls']:
-            if name in queue:
-                if name == queue.split('/')[-1]:
-                    return True
-    return False
+    try:
+        return _client('sqs').get_queue_url(QueueName=name)['QueueUrl']
+    except ClientError as err:
+        if err.response['Error']['Code'] not in (
+                'AWS.SimpleQueueService.NonExistentQueue',
+                'QueueDoesNotExist'):
+            raise
+    return None
 
 
 def _delete_queue(queue_url):
-    session.client('sqs').delete_queue(QueueUrl=queue_url)
+    _client('sqs').delete_queue(QueueUrl=queue_url)
+    registry.forget('sqs', queue_url)
 
 
 def _add_permission_s3_sqs(queue, account_id):
@@ -122,6 +231,28 @@ def _add_permission_s3_sqs(queue, account_id):
     queue.set_attributes(Attributes={'Policy': json.dumps(new_policy)})
 
 
+def _allow_s3_send(queue_url, bucket):
+    '''
+    allow s3 bucket to send its events into queue
+
+    rtype: string, queue arn
+    '''
+    sqs = _client('sqs')
+    queue_arn = sqs.get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    policy = {
+        'Version': '2012-10-17',
+        'Statement': [{
+            'Effect': 'Allow',
+            'Principal': {'Service': 's3.amazonaws.com'},
+            'Action': 'sqs:SendMessage',
+            'Resource': queue_arn,
+            'Condition': {'ArnLike': {'aws:SourceArn': 'arn:aws:s3:::' + bucket}}}]}
+    sqs.set_queue_attributes(QueueUrl=queue_url,
+                             Attributes={'Policy': json.dumps(policy)})
+    return queue_arn
+
+
 # S3
 
 S3_EVENT_CONFIGURATIONS = '''
@@ -140,13 +271,19 @@ S3_EVENT_CONFIGURATIONS = '''
 
 def _is_s3_exist(name):
     '''
-    check for existense
+    check for existense, raise ClientError if the bucket belongs to another
+    account
     '''
-    s3 = session.client('s3')
-    for bucket in s3.list_buckets()['Buckets']:
-        if name == bucket['Name']:
-            return True
-    return False
+    try:
+        _client('s3').head_bucket(Bucket=name)
+        return True
+    except ClientError as err:
+        code = err.response['Error']['Code']
+        if code in ('404', 'NoSuchBucket'):
+            return False
+        if code == '403':
+            print('s3 bucket %s belongs to another account, choose another name' % name)
+        raise
 
 
 def _get_or_create_s3(name, region):
@@ -154,18 +291,21 @@ def _get_or_create_s3(name, region):
     create s3 bucket if not existed
     rtype: string
     '''
+    if registry.get('s3', name):
+        return name
     if not _is_s3_exist(name):
-        session.client('s3').create_bucket(Bucket=name, CreateBucketConfiguration=None \
+        _client('s3').create_bucket(Bucket=name, CreateBucketConfiguration=None \
                                                         if region == 'us-east-1' \
                                                          else {'LocationConstraint': region})
         print('create s3 bucket %s.' % name)
     else:
         print('find s3 bucket %s.' % name)
+    registry.add('s3', name, name)
     return name
 
 
 def _add_permission_s3_lambda(s3_name, lambda_arn):
-    lm = session.client('lambda')
+    lm = _client('lambda')
     source = 'arn:aws:s3:::' + s3_name
     func = lm.get_function(FunctionName=lambda_arn)['Configuration']
     lm.add_permission(FunctionName=func['FunctionName'], StatementId='Allow_s3_invoke', Action='lambda:InvokeFunction', Principal='s3.amazonaws.com', SourceArn=source)
@@ -197,7 +337,7 @@ def _set_event(name, event_arn, option):
 
     config = json.loads(config)
 
-    session.client('s3').put_bucket_notification_configuration(
+    _client('s3').put_bucket_notification_configuration(
         Bucket=name, NotificationConfiguration=config)
 
     print('finish setup s3 bucket %s event notification' % name)
@@ -241,16 +381,111 @@ def _generate_task_definition(image_info, user_info, credentials):
     '''
     image_info.init_all_variables(user_info, credentials)
     task_def = image_info.generate_task()
-    task = session.client('ecs').register_task_definition(family=task_def[
+    task = _client('ecs').register_task_definition(family=task_def[
         'family'], containerDefinitions=task_def['containerDefinitions'])
     # task name: task_def['family']
     return task
 
 
+def _create_service(stage):
+    '''
+    keep the task of stage running as an ecs service of one task, placed on
+    its instance types like the lambda function places tasks. The service
+    is named after the task family.
+
+    rtype: string, service name
+    '''
+    ecs = _client('ecs')
+    kwargs = {}
+    if stage['capacity_provider']:
+        kwargs['capacityProviderStrategy'] = [{
+            'capacityProvider': stage['capacity_provider'], 'weight': 1}]
+    else:
+        print('no capacity provider for {}, the service runs on instances already in the cluster'.format(stage['name']))
+        kwargs['launchType'] = 'EC2'
+    if stage['placement'] == 'spread':
+        strategy = [{'type': 'spread', 'field': 'instanceId'}]
+    else:
+        strategy = [{'type': 'binpack', 'field': 'memory'}]
+
+    ecs.create_service(
+        cluster=ECS_CLUSTER, serviceName=stage['task'],
+        taskDefinition=stage['task'], desiredCount=1,
+        placementConstraints=[{
+            'type': 'memberOf',
+            'expression': 'attribute:ecs.instance-type in [{}]'.format(
+                ', '.join(stage['instance_types']))}],
+        placementStrategy=strategy, **kwargs)
+    return stage['task']
+
+
+def _scale_service(service, stage):
+    '''
+    scale the desired count of service between 1 and max_tasks of stage,
+    one task for every files_per_task files waiting or in process on the
+    stage queue. A CloudWatch alarm on the queue, always in alarm, invokes
+    a step scaling policy setting the exact count every minute, so only SQS
+    metrics are needed.
+    '''
+    resource = 'service/{}/{}'.format(ECS_CLUSTER, service)
+    scaling = _client('application-autoscaling')
+    scaling.register_scalable_target(
+        ServiceNamespace='ecs', ResourceId=resource,
+        ScalableDimension='ecs:service:DesiredCount',
+        MinCapacity=1, MaxCapacity=stage['max_tasks'])
+
+    # task count of each step, from 1 up to max_tasks in at most
+    # MAX_SCALING_STEPS steps
+    steps = max(1, min(stage['max_tasks'], MAX_SCALING_STEPS) - 1)
+    counts = sorted(set([1] + [-(-i * stage['max_tasks'] // steps)
+                               for i in range(1, steps + 1)]))
+    adjustments = []
+    lower = 0
+    for count in counts:
+        step = {'MetricIntervalLowerBound': float(lower),
+                'ScalingAdjustment': count}
+        if count != counts[-1]:
+            step['MetricIntervalUpperBound'] = float(
+                count * stage['files_per_task'])
+        adjustments.append(step)
+        lower = count * stage['files_per_task']
+
+    policy = scaling.put_scaling_policy(
+        PolicyName=service + '-backlog', ServiceNamespace='ecs',
+        ResourceId=resource, ScalableDimension='ecs:service:DesiredCount',
+        PolicyType='StepScaling',
+        StepScalingPolicyConfiguration={
+            'AdjustmentType': 'ExactCapacity',
+            'StepAdjustments': adjustments,
+            'Cooldown': SERVICE_SCALE_COOLDOWN,
+            'MetricAggregationType': 'Maximum'})
+
+    queue = [{'Name': 'QueueName', 'Value': stage['sqs'].split('/')[-1]}]
+    metrics = []
+    for name, metric in [('waiting', 'ApproximateNumberOfMessagesVisible'),
+                         ('running',
+                          'ApproximateNumberOfMessagesNotVisible')]:
+        metrics.append({
+            'Id': name, 'ReturnData': False,
+            'MetricStat': {'Metric': {'Namespace': 'AWS/SQS',
+                                      'MetricName': metric,
+                                      'Dimensions': queue},
+                           'Period': 60, 'Stat': 'Maximum'}})
+    metrics.append({'Id': 'backlog', 'Expression': 'waiting + running',
+                    'Label': 'files waiting or in process',
+                    'ReturnData': True})
+    _client('cloudwatch').put_metric_alarm(
+        AlarmName=service + '-backlog', Metrics=metrics,
+        EvaluationPeriods=1, Threshold=0.0,
+        ComparisonOperator='GreaterThanOrEqualToThreshold',
+        TreatMissingData='breaching',
+        AlarmActions=[policy['PolicyARN']])
+
+
 def _delete_task_definition(task):
     # should be wrong
     # TODO: find the correct way to delete task
-    session.client('ecs').deregister_task_definition(taskDefinition=task)
+    _client('ecs').deregister_task_definition(taskDefinition=task)
 
 # iam
 
@@ -261,11 +496,11 @@ def create_lambda_exec_role():
     sqs, start ec2 and register cloudwatch
     '''
     # create role
-    iam = session.client('iam')
+    iam = _client('iam')
     policy = json.dumps(LAMBDA_EXECUTION_ROLE_TRUST_POLICY, sort_keys=True)
 
     try:
-        res = iam.get_role(LAMBDA_EXEC_ROLE_NAME)
+        res = iam.get_role(RoleName=LAMBDA_EXEC_ROLE_NAME)
         _policy = res['Role']['AssumeRolePolicyDocument']
         if _policy is not None and json.dumps(policy) == policy:
             pass
@@ -277,28 +512,92 @@ def create_lambda_exec_role():
         print('creating role %s', LAMBDA_EXEC_ROLE_NAME)
         iam.create_role(RoleName=LAMBDA_EXEC_ROLE_NAME,
                         AssumeRolePolicyDocument=policy)
-        res = iam.get_role(LAMBDA_EXEC_ROLE_NAME)
+        res = iam.get_role(RoleName=LAMBDA_EXEC_ROLE_NAME)
 
     # add policy
-    exec_policy = json.dumps(LAMBDA_EXEC_ROLE, sort_keys=True)
+    _update_lambda_exec_policy()
+
+
+def _update_lambda_exec_policy():
+    '''
+    add the actions and resources of LAMBDA_EXEC_ROLE missing from the
+    LambdaExec policy of the lambda exec role, so an existing role gains
+    those newer lambda functions use. Permissions already granted are kept.
+    '''
+    iam = _client('iam')
+    try:
+        res = iam.get_role_policy(RoleName=LAMBDA_EXEC_ROLE_NAME,
+                                  PolicyName='LambdaExec')
+        document = res['PolicyDocument']
+    except ClientError:
+        document = {'Version': LAMBDA_EXEC_ROLE['Version'], 'Statement': []}
+
+    statements = _missing_statements(document,
+                                     LAMBDA_EXEC_ROLE['Statement'][0])
+    if not statements:
+        return
+
+    print('updating policy of role {}'.format(LAMBDA_EXEC_ROLE_NAME))
+    document['Statement'] = _as_list(document.get('Statement', [])) + \
+        statements
+    iam.put_role_policy(RoleName=LAMBDA_EXEC_ROLE_NAME,
+                        PolicyName='LambdaExec',
+                        PolicyDocument=json.dumps(document, sort_keys=True))
 
-    res = iam.list_role_policies(RoleName=LAMBDA_EXEC_ROLE_NAME)
 
-    found = False
-    for name in res['PolicyNames']:
-        found = (name == 'LambdaExec')
-        if found:
-            break
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
 
-    if not found:
-        iam.put_role_policy(RoleName=LAMBDA_EXEC_ROLE_NAME, PolicyName='LambdaExec', PolicyDocument=exec_policy)
+
+def _missing_statements(document, wanted):
+    '''
+    statements granting the actions and resources of statement wanted that
+    no Allow statement of policy document grants. Wildcards of document,
+    such as ec2:Describe* or *, are honoured.
+
+    rtype: list
+    '''
+    actions = []
+    resources = []
+    for statement in _as_list(document.get('Statement', [])):
+        if statement.get('Effect') != 'Allow':
+            continue
+        actions.extend(_as_list(statement.get('Action', [])))
+        resources.extend(_as_list(statement.get('Resource', [])))
+
+    missing_actions = [
+        action for action in wanted['Action']
+        if not any(fnmatchcase(action.lower(), granted.lower())
+                   for granted in actions)]
+    missing_resources = [
+        resource for resource in wanted['Resource']
+        if not any(fnmatchcase(resource, granted) for granted in resources)]
+
+    statements = []
+    if missing_actions:
+        statements.append({'Action': missing_actions, 'Effect': 'Allow',
+                           'Resource': wanted['Resource']})
+    if missing_resources:
+        statements.append({'Action': wanted['Action'], 'Effect': 'Allow',
+                           'Resource': missing_resources})
+    return statements
+
+
+def _get_lambda_exec_role():
+    '''
+    arn of the lambda exec role, with its policy brought up to date
+
+    rtype: string
+    '''
+    _update_lambda_exec_policy()
+    return _get_role_arn(LAMBDA_EXEC_ROLE_NAME)
 
 
 def _get_role_arn(role_name):
     '''
     '''
     try:
-        res = session.client('iam').get_role(RoleName=role_name)
+        res = _client('iam').get_role(RoleName=role_name)
     except ClientError as e:
         print(e)
         print('Does not have role %s, make sure you have permission on creating iam role and run create-lambda-exec-role()', role_name)
@@ -306,6 +605,187 @@ def _get_role_arn(role_name):
     return res['Role']['Arn']
 
 
+# capacity
+
+def _get_capacity_name(instance_types):
+    '''
+    name of the launch template, auto scaling group and ecs capacity provider
+    of a list of instance types
+
+    rtype: string
+    '''
+    return 'yunpipe-' + '-'.join(instance_types).replace('.', '-')
+
+
+def _get_or_create_launch_template(instance_types, sys_info):
+    '''
+    launch template of ecs instances joining ECS_CLUSTER, of the first of
+    instance_types unless overridden by the auto scaling group
+
+    rtype: string, template name
+    '''
+    name = _get_capacity_name(instance_types)
+    ec2 = _client('ec2')
+    try:
+        ec2.describe_launch_templates(LaunchTemplateNames=[name])
+        return name
+    except ClientError:
+        pass
+
+    user_data = '#!/bin/bash\necho ECS_CLUSTER={} >> /etc/ecs/ecs.config\n'
+    ec2.create_launch_template(
+        LaunchTemplateName=name,
+        LaunchTemplateData={
+            'ImageId': sys_info['image_id'],
+            'InstanceType': instance_types[0],
+            'KeyName': sys_info['key_pair'],
+            'IamInstanceProfile': {'Name': sys_info['iam_name']},
+            'UserData': b64encode(
+                user_data.format(ECS_CLUSTER).encode()).decode()})
+    return name
+
+
+def _get_or_create_auto_scaling_group(instance_types, sys_info, capacity):
+    '''
+    auto scaling group launching the first of instance_types with capacity
+    available, in order. Its size limits are updated to capacity if it
+    exists.
+
+    rtype: string, auto scaling group arn
+    '''
+    name = _get_capacity_name(instance_types)
+    autoscaling = _client('autoscaling')
+    groups = autoscaling.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[name])['AutoScalingGroups']
+    if groups:
+        autoscaling.update_auto_scaling_group(
+            AutoScalingGroupName=name, MinSize=capacity['min_size'],
+            MaxSize=capacity['max_size'])
+        return groups[0]['AutoScalingGroupARN']
+
+    template = _get_or_create_launch_template(instance_types, sys_info)
+    autoscaling.create_auto_scaling_group(
+        AutoScalingGroupName=name,
+        MixedInstancesPolicy={
+            'LaunchTemplate': {
+                'LaunchTemplateSpecification': {
+                    'LaunchTemplateName': template, 'Version': '$Latest'},
+                'Overrides': [{'InstanceType': t} for t in instance_types]},
+            # on capacity errors fall back to the next instance type
+            'InstancesDistribution': {
+                'OnDemandAllocationStrategy': 'prioritized'}},
+        MinSize=capacity['min_size'], MaxSize=capacity['max_size'],
+        DesiredCapacity=capacity['min_size'],
+        VPCZoneIdentifier=sys_info['subnet_id'])
+    groups = autoscaling.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[name])['AutoScalingGroups']
+    return groups[0]['AutoScalingGroupARN']
+
+
+def _get_or_create_capacity_provider(instance_types, sys_info, capacity):
+    '''
+    ecs capacity provider of instance_types. Managed scaling tracks
+    capacity['target_capacity'] percent of reservation, launching instances
+    for tasks waiting in PROVISIONING.
+
+    rtype: string, capacity provider name
+    '''
+    name = _get_capacity_name(instance_types)
+    arn = _get_or_create_auto_scaling_group(instance_types, sys_info,
+                                            capacity)
+
+    ecs = _client('ecs')
+    providers = ecs.describe_capacity_providers(
+        capacityProviders=[name])['capacityProviders']
+    if any(p['status'] == 'ACTIVE' for p in providers):
+        return name
+
+    ecs.create_capacity_provider(
+        name=name,
+        autoScalingGroupProvider={
+            'autoScalingGroupArn': arn,
+            'managedScaling': {
+                'status': 'ENABLED',
+                'targetCapacity': capacity['target_capacity'],
+                'minimumScalingStepSize': 1,
+                'maximumScalingStepSize': capacity['max_size']},
+            'managedTerminationProtection': 'DISABLED'})
+    return name
+
+
+def _add_cluster_capacity_providers(names):
+    '''
+    associate capacity providers with ECS_CLUSTER, keeping those already
+    associated
+    '''
+    ecs = _client('ecs')
+    # create_cluster returns the existing cluster
+    ecs.create_cluster(clusterName=ECS_CLUSTER)
+    cluster = ecs.describe_clusters(clusters=[ECS_CLUSTER])['clusters'][0]
+    existing = cluster.get('capacityProviders', [])
+    if set(names) <= set(existing):
+        return
+    ecs.put_cluster_capacity_providers(
+        cluster=ECS_CLUSTER,
+        capacityProviders=existing + [n for n in names if n not in existing],
+        defaultCapacityProviderStrategy=cluster.get(
+            'defaultCapacityProviderStrategy', []))
+
+
+def setup_capacity(user_request, sys_info):
+    '''
+    set up one capacity provider for each list of instance types used in
+    the work flow, unless user_request['capacity'] is false
+
+    rtype: dict, capacity provider name of each list of instance types,
+    joined by comma
+    '''
+    if user_request.get('capacity', {}) is False:
+        return {}
+    capacity = dict(DEFAULT_CAPACITY)
+    capacity.update(user_request.get('capacity', {}))
+
+    instance_types = set()
+    for alg in user_request['process']['algorithms']:
+        instance_types.add(
+            ','.join(get_image_info(alg['name']).instance_types))
+
+    providers = {}
+    for types in sorted(instance_types):
+        providers[types] = _get_or_create_capacity_provider(
+            types.split(','), sys_info, capacity)
+    _add_cluster_capacity_providers(list(providers.values()))
+    return providers
+
+
+# cluster state
+
+def _get_or_create_state_table():
+    '''
+    create the DynamoDB table keeping one snapshot of container instances
+    for each cluster, shared by the lambda functions
+
+    rtype: string, table name
+    '''
+    dynamodb = _client('dynamodb')
+    try:
+        dynamodb.describe_table(TableName=STATE_TABLE)
+        return STATE_TABLE
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+
+    print('creating cluster state table {}'.format(STATE_TABLE))
+    dynamodb.create_table(
+        TableName=STATE_TABLE,
+        AttributeDefinitions=[{'AttributeName': 'cluster',
+                               'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'cluster', 'KeyType': 'HASH'}],
+        BillingMode='PAY_PER_REQUEST')
+    dynamodb.get_waiter('table_exists').wait(TableName=STATE_TABLE)
+    return STATE_TABLE
+
+
 # lambda
 
 def _generate_lambda(image, sys_info, request, task_name):
@@ -320,8 +800,14 @@ def _generate_lambda(image, sys_info, request, task_name):
     rtype: string
     '''
     lambda_para = {}
-    lambda_para['instance_type'] = image.instance_type
-    lambda_para['memory'] = image.memory
+    lambda_para['instance_types'] = json.dumps(image.instance_types)
+    lambda_para['memory'] = image.get_task_memory()
+    lambda_para['cpu'] = image.get_task_cpu()
+    lambda_para['placement'] = request.get('placement', 'bestfit')
+    lambda_para['files_per_task'] = request.get('files_per_task', 10)
+    lambda_para['max_tasks'] = request.get('max_tasks', 10)
+    lambda_para['capacity_provider'] = sys_info['capacity_providers'].get(
+        ','.join(image.instance_types), '')
     lambda_para['task_name'] = task_name
     lambda_para.update(request)
     lambda_para.update(sys_info)
@@ -345,18 +831,23 @@ def _create_deploy_package(lambda_code, zipname):
     '''
     generate the deploy package
     '''
-    # TODO: check correctness
-    file_path = os.path.join(CLOUD_PIPE_TMP_FOLDER, 'lambda_function.py')
-    with open(file_path, 'w+') as run_file:
-        run_file.write(lambda_code)
+    # written straight into the zip, stages are packaged concurrently.
+    # Lambda needs the file readable by others.
+    info = ZipInfo('lambda_function.py', date_time=localtime()[:6])
+    info.external_attr = 0o644 << 16
     with ZipFile(zipname, 'w') as codezip:
-        codezip.write(file_path, arcname='lambda_function.py')
-    os.remove(file_path)
+        codezip.writestr(info, lambda_code)
 
 
-def _create_lambda_func(zipname):
+def _create_lambda_func(zipname, config=None, role=None):
     '''
     create lambda function using a .zip deploy package
+
+    para: config: runtime, memory and timeout, DEFAULT_LAMBDA if None
+    type: dict
+
+    para: role: arn of the lambda exec role, looked up if None
+    type: string
     '''
     # code = io.BytesIO()
     # with ZipFile(code, 'w') as z:
@@ -366,8 +857,9 @@ def _create_lambda_func(zipname):
     with open(zipname, 'rb') as tmpfile:
         code = tmpfile.read()
     name = name_generator.haikunate()
-    role = _get_role_arn(LAMBDA_EXEC_ROLE_NAME)
-    res = session.client('lambda').create_function(FunctionName=name, Runtime='python2.7', Role=role, Handler='lambda_function.lambda_handler', Code={'ZipFile': code}, Timeout=LAMBDA_EXEC_TIME, MemorySize=128)
+    role = role or _get_role_arn(LAMBDA_EXEC_ROLE_NAME)
+    config = config or DEFAULT_LAMBDA
+    res = _client('lambda').create_function(FunctionName=name, Runtime=config['runtime'], Role=role, Handler='lambda_function.lambda_handler', Code={'ZipFile': code}, Timeout=config['timeout'], MemorySize=config['memory'])
 
     # TODO: also remove lambda_function.py
     os.remove(zipname)
@@ -375,8 +867,39 @@ def _create_lambda_func(zipname):
     return res['FunctionArn']
 
 
+def _probe_lambda(name):
+    '''
+    invoke the new lambda function once with a probe event, which returns
+    right after loading, and print the init and handler durations Lambda
+    reports for it
+
+    rtype: dict, init_ms, duration_ms, memory_mb and max_memory_mb, a
+    value missing if not reported
+    '''
+    client = _client('lambda')
+    client.get_waiter('function_active_v2').wait(FunctionName=name)
+    res = client.invoke(FunctionName=name, LogType='Tail',
+                        Payload=json.dumps({'yunpipe': 'probe'}))
+    log = b64decode(res.get('LogResult', '')).decode('utf-8', 'replace')
+
+    report = {}
+    fields = {'Init Duration': 'init_ms', 'Duration': 'duration_ms',
+              'Memory Size': 'memory_mb', 'Max Memory Used': 'max_memory_mb'}
+    for line in log.splitlines():
+        if not line.startswith('REPORT'):
+            continue
+        for field in line.split('\t'):
+            key, _, value = field.partition(':')
+            if key.strip() in fields and value.strip():
+                report[fields[key.strip()]] = float(value.split()[0])
+    print('lambda {}: cold start init {} ms, handler {} ms, {} of {} MB used'.format(
+        name.split(':')[-1], report.get('init_ms'), report.get('duration_ms'),
+        report.get('max_memory_mb'), report.get('memory_mb')))
+    return report
+
+
 def _deleta_lambda(name):
-    session.client('lambda').delete_function(FunctionName=name)
+    _client('lambda').delete_function(FunctionName=name)
 
 
 # utilities for setting up the whole thing
@@ -399,7 +922,7 @@ def get_image_info(name):
 
 def _get_subnet_id():
     from random import randint
-    ec2 = session.client('ec2')
+    ec2 = _client('ec2')
     response = ec2.describe_subnets()
     subnet_id = ""
     subnets = response['Subnets']
@@ -411,11 +934,10 @@ def _get_subnet_id():
     return subnet_id
     
 def _get_ecs_optimized_AMI_id():
-    ec2 = session.client('ec2')
-    response = ec2.describe_images(Owners=['amazon',],\
-                                   Filters=[{'Name':'name','Values':['amzn-ami-2016.09.f-amazon-ecs-optimized',]},]) 
-    ami_id = response['Images'][0]['ImageId']
-    return ami_id
+    # latest ecs optimized AMI of the region
+    ssm = _client('ssm')
+    response = ssm.get_parameter(Name=ECS_AMI_PARAMETER)
+    return response['Parameter']['Value']
 
 def _get_sys_info(key_pair, account_id, region):
     '''
@@ -474,8 +996,9 @@ def scatter_all(prev_s3, later_lambda_list):
 
 def pipeline_setup(request, sys_info, clean, credentials):
     '''
-    receive a json format of request, set up one run instance including sqs,
-    input/output s3, lambda, (cloudwatch shutdown alarm) and ecs task definition.
+    receive a json format of request, set up one run instance including
+    lambda (or ecs service) and ecs task definition. The sqs queue and s3
+    buckets are set up by main() and request['sqs'] is the queue url.
     para: request:
     {
         "name": "",
@@ -484,6 +1007,15 @@ def pipeline_setup(request, sys_info, clean, credentials):
         "alarm_sqs": "",
         "input_s3_name": "",
         "output_s3_name": "",
+        "workers": 1,
+        "transfer": {"chunk_size": 64, "max_concurrency": 10},
+        "result_cache": true,
+        "archive": {"format": "zip", "level": 6},
+        "batch": {"size": 10, "wait": 5},
+        "placement": "bestfit",
+        "files_per_task": 10,
+        "max_tasks": 10,
+        "mode": "task",
         "variables":
         {
             "name": "value"
@@ -493,18 +1025,23 @@ def pipeline_setup(request, sys_info, clean, credentials):
 
     para:sys_info
 
+    rtype: tuple, the stage as scheduled by yunpipe-scheduler, and the arn
+    and type ('lambda' or 'sqs') of the target of input s3 events
     '''
-    # set sqs
-    request['sqs'] = _get_or_create_queue(request['sqs'])
-    clean['sqs'].append(request['sqs'])
-
     # set ecs task
     image = get_image_info(request['name'])
 
     # info only need port, variables, output_s3_name, NAME & sqs
     info = {}
     info['port'] = request['port']
-    info['variables'] = request['variables']
+    info['variables'] = dict(request['variables'])
+    info['workers'] = request.get('workers', 1)
+    info['transfer'] = request.get('transfer', {})
+    if 'result_cache' in request:
+        info['result_cache'] = request['result_cache']
+    info['archive'] = request.get('archive', {})
+    info['batch'] = request.get('batch', {})
+    info['mode'] = request.get('mode', 'task')
     # Changable, need to change on senquential run
     info['variables']['output_s3_name'] = request['output_s3_name']
     # QueueUrl
@@ -517,67 +1054,280 @@ def pipeline_setup(request, sys_info, clean, credentials):
 
     # print(json.dumps(task, sort_keys=True, indent='    '))
 
+    stage = {}
+    stage['name'] = request['name']
+    stage['sqs'] = request['sqs']
+    stage['task'] = task['taskDefinition']['family']
+    stage['cpu'] = image.get_task_cpu()
+    stage['memory'] = image.get_task_memory()
+    stage['instance_types'] = image.instance_types
+    stage['capacity_provider'] = sys_info['capacity_providers'].get(
+        ','.join(image.instance_types), '')
+    stage['placement'] = request.get('placement', 'bestfit')
+    stage['files_per_task'] = request.get('files_per_task', 10)
+    stage['max_tasks'] = request.get('max_tasks', 10)
+    stage['mode'] = request.get('mode', 'task')
+
+    if stage['mode'] == 'service':
+        service = _create_service(stage)
+        _scale_service(service, stage)
+        clean['service'].append(service)
+
+    if stage['mode'] == 'service' or sys_info['scheduler']:
+        # the service or yunpipe-scheduler starts tasks, s3 events go to the
+        # queue directly
+        return stage, (request['sqs'], 'sqs')
+
     # set lambda
     code = _generate_lambda(image, sys_info, request, task['taskDefinition']['family'])
 
     zipname = os.path.join(CLOUD_PIPE_TMP_FOLDER, request['name'] + name_generator.haikunate() + '.zip')
     _create_deploy_package(code, zipname)
-    lambda_arn = _create_lambda_func(zipname)
+    config = dict(DEFAULT_LAMBDA)
+    config.update(sys_info['lambda'])
+    config.update(request.get('lambda', {}))
+    lambda_arn = _create_lambda_func(zipname, config, sys_info['lambda_role'])
     clean['lambda'].append(lambda_arn)
+    return stage, (lambda_arn, 'lambda')
 
-    # set s3
-    input_s3 = _get_or_create_s3(request['input_s3_name'], sys_info['region'])
-    _set_event(input_s3, lambda_arn, 'lambda')
 
-    output_s3 = _get_or_create_s3(request['output_s3_name'], sys_info['region'])
-    clean['s3'].append(input_s3)
-    clean['s3'].append(output_s3)
+def _set_stage_event(bucket, target):
+    '''
+    send the object created events of bucket to target of a stage, see
+    pipeline_setup()
+    '''
+    arn, option = target
+    if option == 'sqs':
+        arn = _allow_s3_send(arn, bucket)
+    _set_event(bucket, arn, option)
 
 
-def main(user_request, credentials):
+def _setup_stage(results, i, request, sys_info, credentials):
     '''
-    parse the user_request json, then setup the whole thing
-    para: user_request
-    type: json
+    pipeline_setup() of stage i, with its queue, the capacity providers,
+    state table, lambda role and alarm queue set up before
 
-    support only 'single_run' for now
+    rtype: dict, the stage as kept in the pipeline manifest
+    '''
+    stage_info = dict(sys_info)
+    stage_info['capacity_providers'] = results['capacity']
+    stage_info['state_table'] = results['state_table']
+    stage_info['lambda_role'] = results['role']
+    request['alarm_sqs'] = results['alarm']
+    # a new stage gets its queue in this run, a changed one keeps its queue
+    request['sqs'] = results.get('sqs:{}'.format(i), request['sqs'])
+
+    resources = {'task': [], 'lambda': [], 'service': []}
+    stage, target = pipeline_setup(request, stage_info, resources,
+                                   credentials)
+    return {'name': request['name'], 'spec': request['spec'],
+            'mode': stage['mode'], 'scheduler': sys_info['scheduler'],
+            'sqs': request['sqs'], 'sqs_name': request['sqs_name'],
+            'input_s3_name': request['input_s3_name'],
+            'output_s3_name': request['output_s3_name'],
+            'resources': resources, 'stage': stage, 'target': list(target)}
+
+
+def _probe_stage(target):
     '''
-    sys_info = _get_sys_info(user_request['key_pair'], user_request[
-                             'account_id'], user_request['region'])
+    measure the cold start of the lambda function of a stage
+    '''
+    arn, option = target
+    if option == 'lambda':
+        return _probe_lambda(arn)
 
-#    print(json.dumps(sys_info, sort_keys=True, indent='    '))
 
-    clean = {}
-    clean['sqs'] = []
-    clean['task'] = []
-    clean['lambda'] = []
-    clean['s3'] = []
-    clean['cloudwatch'] = _get_or_create_queue('shutdown_alarm_sqs')
+def _delete_service(name):
+    '''
+    stop scaling the ecs service of a stage in service mode and delete it
+    '''
+    _client('cloudwatch').delete_alarms(AlarmNames=[name + '-backlog'])
+    _client('application-autoscaling').deregister_scalable_target(
+        ServiceNamespace='ecs', ResourceId='service/{}/{}'.format(
+            ECS_CLUSTER, name),
+        ScalableDimension='ecs:service:DesiredCount')
+    _client('ecs').delete_service(cluster=ECS_CLUSTER, service=name,
+                                  force=True)
 
+
+def _retire_stage(stage, delete_queue=False):
+    '''
+    delete the lambda function or service and task definition of a
+    deployed stage, and its queue if delete_queue
+    '''
+    for name in stage['resources']['service']:
+        _delete_service(name)
+    for arn in stage['resources']['lambda']:
+        _deleta_lambda(arn)
+    for arn in stage['resources']['task']:
+        _delete_task_definition(arn)
+    if delete_queue:
+        _delete_queue(stage['sqs'])
+    print('remove old resources of stage {}'.format(stage['name']))
+
+
+def _unhook_bucket(bucket):
+    '''
+    stop sending the events of a bucket no stage reads any more
+    '''
+    _client('s3').put_bucket_notification_configuration(
+        Bucket=bucket, NotificationConfiguration={})
+
+
+def _read_algorithm_info(name):
+    file_path = os.path.join(CLOUD_PIPE_ALGORITHM_FOLDER, name + '_info.json')
+    with open(file_path, 'r') as tmpfile:
+        return json.load(tmpfile)
+
+
+def main(user_request, credentials, plan_only=False):
+    '''
+    parse the user_request json, then set up the pipeline, changing only
+    the stages that differ from its deployed state, see deploy_state.py
+    para: user_request
+    type: json
+
+    para: plan_only: print the changes without making them
+    type: bool
+    '''
+    name = get_pipeline_name(user_request)
+    deployed = load_manifest(name) or {'buckets': [], 'shared': {},
+                                       'stages': []}
+    workflow = {key: user_request.get(key) for key in WORKFLOW_KEYS}
+    scheduler = user_request.get('scheduler', False)
+
+    # intermediate buckets of a sequence_run are kept by position
+    algorithms = user_request['process']['algorithms']
     if user_request['process']['type'] == 'single_run':
+        algorithms = algorithms[:1]
+    old_buckets = deployed['buckets'][1:-1]
+    s3_names = [user_request['input_s3_name']]
+    for i in range(len(algorithms) - 1):
+        s3_names.append(old_buckets[i] if i < len(old_buckets)
+                        else name_generator.haikunate())
+    s3_names.append(user_request['output_s3_name'])
+
+    requests = []
+    for i, alg in enumerate(algorithms):
         request = {}
-        request.update(user_request['process']['algorithms'][0])
-        request['input_s3_name'] = user_request['input_s3_name']
-        request['output_s3_name'] = user_request['output_s3_name']
-        request['sqs'] = name_generator.haikunate()
-        request['alarm_sqs'] = clean['cloudwatch']
-        pipeline_setup(request, sys_info, clean, credentials)
-    elif user_request['process']['type'] == 'sequence_run':
-        s3_names = []
-        s3_names.append(user_request['input_s3_name'])
-        for _ in range(len(user_request['process']['algorithms']) - 1):
-            s3_names.append(name_generator.haikunate())
-        s3_names.append(user_request['output_s3_name']) 
-        i = 0
-        for alg in user_request['process']['algorithms']:
-            request = {}
-            request.update(user_request['process']['algorithms'][i])
-            request['input_s3_name'] = s3_names[i]
-            request['output_s3_name'] = s3_names[i + 1]
-            request['sqs'] = name_generator.haikunate()
-            request['alarm_sqs'] = clean['cloudwatch']
-            pipeline_setup(request, sys_info, clean, credentials)
-            i += 1
+        request.update(alg)
+        request['input_s3_name'] = s3_names[i]
+        request['output_s3_name'] = s3_names[i + 1]
+        request['spec'] = stage_spec(request, _read_algorithm_info(
+            request['name']), workflow, credentials)
+        if i < len(deployed['stages']):
+            request['sqs_name'] = deployed['stages'][i]['sqs_name']
+            request['sqs'] = deployed['stages'][i]['sqs']
+        else:
+            request['sqs_name'] = request['sqs'] = \
+                name_generator.haikunate()
+        requests.append(request)
+
+    changes = diff_stages([r['spec'] for r in requests], deployed['stages'])
+    wanted = [{'name': r['name'], 'mode': r.get('mode', 'task'),
+               'scheduler': scheduler} for r in requests]
+    built = [i for action, i in changes if action in ('create', 'replace')]
+    new_buckets = [b for b in s3_names if b not in deployed['buckets']]
+    unhook = sorted(set(s['input_s3_name'] for s in deployed['stages']) -
+                    set(r['input_s3_name'] for r in requests))
+    use_lambda = any('lambda' in stage_resources(wanted[i]) for i in built)
+    use_state = use_lambda and user_request.get('cluster_state', True)
+
+    shared = []
+    if built:
+        shared = ['sys_info', 'alarm']
+        if use_lambda:
+            shared.append('role')
+        if use_state:
+            shared.append('state_table')
+        if user_request.get('capacity', {}) is not False:
+            types = set(','.join(get_image_info(alg['name']).instance_types)
+                        for alg in algorithms)
+            shared.extend(['capacity_provider'] * len(types))
+            shared.append('cluster_providers')
+    calls = estimate_calls(changes, wanted, deployed['stages'], new_buckets,
+                           unhook, shared)
+    print(format_plan(name, changes, wanted, deployed['stages'],
+                      new_buckets, unhook, calls))
+    if plan_only or calls == 0:
+        return
+
+    sys_info = dict(deployed['shared'].get('launch', {}))
+    if built:
+        sys_info = _get_sys_info(user_request['key_pair'], user_request[
+                                 'account_id'], user_request['region'])
+    sys_info['scheduler'] = scheduler
+    sys_info['lambda'] = user_request.get('lambda', {})
+
+    # a step only waits for the steps it uses, everything else is set up
+    # concurrently: buckets, queues and shared resources first, then the
+    # task definition and lambda function of each stage once its queue is
+    # there, the bucket notification once both exist, and last the old
+    # resources of a changed stage
+    steps = {}
+    if built:
+        steps['alarm'] = (
+            lambda results: _get_or_create_queue('shutdown_alarm_sqs'), [])
+        steps['capacity'] = (
+            lambda results: setup_capacity(user_request, sys_info), [])
+        steps['state_table'] = (
+            lambda results: _get_or_create_state_table() if use_state
+            else '', [])
+        steps['role'] = (
+            lambda results: _get_lambda_exec_role() if use_lambda else '',
+            [])
+    for bucket in new_buckets:
+        steps['s3:' + bucket] = (
+            lambda results, bucket=bucket: _get_or_create_s3(
+                bucket, user_request['region']), [])
+    for bucket in unhook:
+        steps['unhook:' + bucket] = (
+            lambda results, bucket=bucket: _unhook_bucket(bucket), [])
+    for action, i in changes:
+        stage = 'stage:{}'.format(i)
+        if action == 'delete':
+            steps['delete:{}'.format(i)] = (
+                lambda results, old=deployed['stages'][i]: _retire_stage(
+                    old, delete_queue=True), [])
+            continue
+        if action == 'keep':
+            continue
+        request = requests[i]
+        deps = ['alarm', 'capacity', 'state_table', 'role']
+        if action == 'create':
+            steps['sqs:{}'.format(i)] = (
+                lambda results, request=request: _get_or_create_queue(
+                    request['sqs_name']), [])
+            deps.append('sqs:{}'.format(i))
+        steps[stage] = (
+            lambda results, i=i, request=request: _setup_stage(
+                results, i, request, sys_info, credentials), deps)
+        input_s3 = request['input_s3_name']
+        steps['event:{}'.format(i)] = (
+            lambda results, stage=stage, input_s3=input_s3: _set_stage_event(
+                input_s3, results[stage]['target']),
+            [stage] + (['s3:' + input_s3] if input_s3 in new_buckets else []))
+        steps['probe:{}'.format(i)] = (
+            lambda results, stage=stage: _probe_stage(
+                results[stage]['target']), [stage])
+        if action == 'replace':
+            steps['retire:{}'.format(i)] = (
+                lambda results, old=deployed['stages'][i]: _retire_stage(old),
+                ['event:{}'.format(i)])
+    results = _run_steps(steps)
+
+    manifest = {'name': name, 'request': user_request, 'buckets': s3_names}
+    manifest['shared'] = dict(deployed['shared'])
+    if built:
+        manifest['shared'] = {
+            'alarm': results['alarm'], 'capacity': results['capacity'],
+            'launch': {key: sys_info[key] for key in [
+                'image_id', 'key_pair', 'subnet_id', 'iam_name', 'region',
+                'account_id', 'security_group']}}
+    manifest['stages'] = [results['stage:{}'.format(i)] if i in built
+                          else deployed['stages'][i]
+                          for i in range(len(requests))]
+    save_manifest(name, manifest)
 
     # finish setup
     print('-----------------------------------------------------------')
@@ -585,10 +1335,27 @@ def main(user_request, credentials):
     print('You will get your result at %s' % user_request['output_s3_name'])
     print('-----------------------------------------------------------')
 
+    # clean-up removes every deployed pipeline, and the event rule and
+    # queue of yunpipe-scheduler if any pipeline uses it
+    manifests = load_all_manifests()
+    clean = collect_resources(manifests)
+    if any(stage.get('scheduler') for m in manifests for stage in m['stages']):
+        clean['scheduler_events'] = {'rule': EVENT_RULE, 'queue': EVENT_QUEUE}
     file_path = os.path.join(CLOUD_PIPE_TMP_FOLDER, 'clean_up.json')
     with open(file_path, 'w+') as tmpfile:
         json.dump(clean, tmpfile, sort_keys=True, indent='    ')
 
+    if scheduler:
+        config = {}
+        config['cluster'] = ECS_CLUSTER
+        config['launch'] = dict(manifest['shared']['launch'])
+        config['launch']['alarm_sqs'] = manifest['shared']['alarm']
+        config['stages'] = [stage['stage'] for stage in manifest['stages']]
+        file_path = os.path.join(CLOUD_PIPE_TMP_FOLDER, SCHEDULER_CONFIG)
+        with open(file_path, 'w+') as tmpfile:
+            json.dump(config, tmpfile, sort_keys=True, indent='    ')
+        print('Run yunpipe-scheduler to start processing your files')
+
 
 if __name__ == '__main__':
     with open(sys.argv[1], 'r') as tmpfile:
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import argparse
+import json
+
+from ..wrapper.algorithm_profile import read_algorithm_info
+from ..wrapper.algorithm_profile import load_profiles
+from ..wrapper.algorithm_profile import summarize_profiles
+from ..wrapper.algorithm_profile import suggest_resources
+from ..wrapper.algorithm_profile import update_algorithm_info
+from ..utils import get_true_or_false
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='A tool to suggest memory and CPU of your algorithm from profiles of its runs')
+
+    parser.add_argument('-n', '--name', action='store', required=True,
+                        help='the name of the algorithm used in your work flow json file')
+    parser.add_argument('-b', '--bucket', action='store', required=True,
+                        help='output S3 bucket of a stage running the algorithm')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='write suggestion into algorithm info without asking')
+
+    args = parser.parse_args()
+
+    # session asks for aws credentials if not configured
+    from ..pipeline import session
+
+    info = read_algorithm_info(args.name)
+    profiles = load_profiles(session.client('s3'), args.bucket, info['name'])
+    summary = summarize_profiles(profiles)
+    if summary is None:
+        print('no successful runs of {} found in {}'.format(info['name'],
+                                                            args.bucket))
+        exit(0)
+
+    suggestion = suggest_resources(summary)
+    print(json.dumps(summary, indent='    ', sort_keys=True))
+    print('current: memory {}, CPU {}'.format(json.dumps(info['memory']),
+                                              info.get('CPU')))
+    print('suggested: memory {}, CPU {}'.format(
+        json.dumps(suggestion['memory']), suggestion['CPU']))
+
+    if args.yes or get_true_or_false(
+            'Do you want to update algorithm info? [y/n]:', True):
+        update_algorithm_info(args.name, suggestion)
+
+
+if __name__ == '__main__':
+    main()
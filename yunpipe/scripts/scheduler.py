@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+
+from .. import CLOUD_PIPE_TMP_FOLDER
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='A scheduler starting ecs tasks of your pipelines set up with "scheduler": true')
+
+    parser.add_argument('-f', '--file', action='store',
+                        default=os.path.join(CLOUD_PIPE_TMP_FOLDER,
+                                             'scheduler.json'),
+                        help='stages to schedule, written by setup-pipe')
+    parser.add_argument('-t', '--tick', action='store', type=float,
+                        default=1,
+                        help='seconds between scheduling rounds, default is 1')
+
+    args = parser.parse_args()
+
+    with open(args.file, 'r') as tmpfile:
+        config = json.load(tmpfile)
+
+    # session asks for aws credentials if not configured
+    from ..pipeline.scheduler import scheduler
+
+    try:
+        scheduler(config).run(args.tick)
+    except KeyboardInterrupt:
+        print('scheduler stopped')
+
+
+if __name__ == '__main__':
+    main()
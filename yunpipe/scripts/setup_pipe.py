@@ -15,6 +15,9 @@ def main():
     parser.add_argument('-f', '--files', nargs='+',
                         help='json files to describe your work flow')
 
+    parser.add_argument('-p', '--plan', action='store_true',
+                        help='print the changes to your deployed pipelines and the estimated api calls without making them')
+
     args = parser.parse_args()
 
     if args.files is None:
@@ -26,7 +29,7 @@ def main():
     for file in args.files:
         with open(file, 'r') as tmpfile:
             user_request = json.load(tmpfile)
-        set_pipe.main(user_request, credentials)
+        set_pipe.main(user_request, credentials, args.plan)
 
 
 if __name__ == '__main__':
@@ -1,49 +1,314 @@
 from __future__ import print_function
+from time import time
+init_start = time()
+
 import boto3
+from botocore.exceptions import ClientError
 import json
-from time import time
+import math
+import random
+from time import sleep
 
 print('Loading lambda function')
 
-sqs = boto3.client('sqs')
-ecs = boto3.client('ecs')
-ec2 = boto3.client('ec2')
-cw = boto3.client('cloudwatch')
+# boto3 clients by service name, created on first use by client() to keep
+# the cold start short
+clients = {}
+
+# launch time of instances from create_ec2() not yet joined the cluster,
+# forgotten after LAUNCH_TIMEOUT seconds
+launched = {}
+LAUNCH_TIMEOUT = 600
+
+# instance types this algorithm runs on in order of preference
+INSTANCE_TYPES = %(instance_types)s
+
+# launch errors after which the next instance type is tried
+CAPACITY_ERRORS = {'InsufficientInstanceCapacity', 'InstanceLimitExceeded',
+                   'Unsupported'}
+
+# memory of an instance type not registered with ECS, for the agent and os
+INSTANCE_OVERHEAD = 0.1
 
-# maintain a set of container instance arn that isnot the instance_type wanted
-instances = set()
+# CPU units and MB of memory of each instance type, see get_instance_size()
+instance_sizes = {}
 
-ec2InstanceId = ''
+# resources reserved by one task
+TASK_CPU = %(cpu)s
+TASK_MEMORY = %(memory)s
 
-# def find_container(cluster, instance_id):
-#     while True:
-#         ins = ecs.list_container_instances(cluster=cluster)
-#         ins = ecs.describe_container_instances(
-#             cluster=cluster, containerInstances=ins['containerInstanceArns'])
-#         ins = ins['containerInstances']
-#         for info in ins:
-#             if info['ec2InstanceId'] == instance_id:
-#                 return info['containerInstanceArn']
-#         # print('run {} times'.format(i))
-#         # i += 1
+# tasks wanted for the queue backlog: one for every FILES_PER_TASK files
+# waiting or in process, at most MAX_TASKS of this stage running at a time
+FILES_PER_TASK = %(files_per_task)s
+MAX_TASKS = %(max_tasks)s
 
+# capacity provider of the instance type, tasks not fitting on running
+# instances wait in PROVISIONING while it launches instances. Empty if the
+# pipeline launches instances itself, see create_ec2()
+CAPACITY_PROVIDER = '%(capacity_provider)s'
+RUN_TASK_LIMIT = 10
 
-def get_instances_arns(cluster):
+# how a container instance is chosen for a task, see choose_instance()
+PLACEMENT_STRATEGY = '%(placement)s'
+
+# most container instances in one describe_container_instances and
+# start_task call
+DESCRIBE_LIMIT = 100
+START_TASK_LIMIT = 10
+
+# snapshot of the cluster container instances shared by the lambda functions
+# of every stage in DynamoDB table STATE_TABLE, described again once older
+# than SNAPSHOT_TTL seconds. Placements are written back to it with the
+# version read and planned again, at most SNAPSHOT_RETRIES times, when
+# another function wrote first. Without STATE_TABLE the snapshot is kept in
+# local_snapshots of this lambda container only.
+STATE_TABLE = '%(state_table)s'
+SNAPSHOT_TTL = 5
+SNAPSHOT_RETRIES = 3
+local_snapshots = {}
+
+# seconds between placement retries while a new instance joins the cluster,
+# doubling from PLACEMENT_BASE_DELAY up to PLACEMENT_MAX_DELAY with full
+# jitter. Retrying stops DEADLINE_MARGIN seconds before the lambda times out
+PLACEMENT_BASE_DELAY = 1
+PLACEMENT_MAX_DELAY = 16
+DEADLINE_MARGIN = 10
+
+
+def client(name):
     '''
-    find all the instances that have the instance_type we want
+    rtype: the boto3 client of service name, kept for later invocations
+    '''
+    if name not in clients:
+        clients[name] = boto3.client(name)
+    return clients[name]
+
+
+def get_backlog():
+    '''
+    rtype: int, approximate number of files waiting or in process on the
+    stage queue
+    '''
+    response = client('sqs').get_queue_attributes(
+        QueueUrl='%(sqs)s',
+        AttributeNames=['ApproximateNumberOfMessages',
+                        'ApproximateNumberOfMessagesNotVisible'])
+    attributes = response['Attributes']
+    return int(attributes['ApproximateNumberOfMessages']) + \
+        int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+
+def count_running_tasks(cluster):
+    '''
+    rtype: int, tasks of this stage running or about to run
+    '''
+    count = 0
+    kwargs = {'cluster': cluster, 'family': '%(task_name)s',
+              'desiredStatus': 'RUNNING'}
+    response = client('ecs').list_tasks(**kwargs)
+    count += len(response['taskArns'])
+    while response.get('nextToken', None) is not None:
+        response = client('ecs').list_tasks(nextToken=response['nextToken'],
+                                            **kwargs)
+        count += len(response['taskArns'])
+    return count
+
+
+def tasks_needed(cluster):
+    '''
+    number of tasks to start so that running tasks are proportional to the
+    queue backlog, capped by MAX_TASKS
+
+    rtype: int
+    '''
+    backlog = get_backlog()
+    running = count_running_tasks(cluster)
+    # the file just queued may not be counted yet
+    wanted = max(1, int(math.ceil(float(backlog) / FILES_PER_TASK)))
+    wanted = min(MAX_TASKS, wanted)
+    print('backlog {}, running tasks {}, wanted tasks {}'.format(
+        backlog, running, wanted))
+    return max(0, wanted - running)
+
+
+def get_resources(instance, key='remainingResources'):
+    '''
+    rtype: tuple, CPU units and MEMORY in MB of instance[key]
+    '''
+    resources = {r['name']: r.get('integerValue', 0) for r in instance[key]}
+    return resources.get('CPU', 0), resources.get('MEMORY', 0)
+
+
+def describe_cluster(cluster):
+    '''
+    describe the active container instances of cluster, at most
+    DESCRIBE_LIMIT in one call
+
+    rtype: list of dict, arn, ec2, type, connected, free cpu and memory and
+    total_cpu and total_memory of each instance
     '''
     arns = []
-    response = ecs.list_container_instances(cluster=cluster)
-    arns.extend(
-        [i for i in response['containerInstanceArns'] if i not in instances])
+    kwargs = {'cluster': cluster, 'status': 'ACTIVE'}
+    response = client('ecs').list_container_instances(**kwargs)
+    arns.extend(response['containerInstanceArns'])
     while response.get('nextToken', None) is not None:
-        response = ecs.list_container_instances(
-            cluster=cluster, nextToken=response['nextToken'])
-        arns.extend(
-            [i for i in response['containerInstanceArns']
-                if i not in instances])
+        response = client('ecs').list_container_instances(
+            nextToken=response['nextToken'], **kwargs)
+        arns.extend(response['containerInstanceArns'])
+
+    instances = []
+    for i in range(0, len(arns), DESCRIBE_LIMIT):
+        for item in client('ecs').describe_container_instances(
+                cluster=cluster, containerInstances=arns[i:i + DESCRIBE_LIMIT]
+        )['containerInstances']:
+            attributes = {a['name']: a.get('value')
+                          for a in item.get('attributes', [])}
+            cpu, memory = get_resources(item)
+            total_cpu, total_memory = get_resources(item,
+                                                    'registeredResources')
+            instances.append({
+                'arn': item['containerInstanceArn'],
+                'ec2': item['ec2InstanceId'],
+                'type': attributes.get('ecs.instance-type'),
+                'connected': item.get('agentConnected', True),
+                'cpu': cpu, 'memory': memory,
+                'total_cpu': total_cpu, 'total_memory': total_memory})
+    return instances
+
+
+def read_snapshot(cluster):
+    '''
+    rtype: dict, the shared snapshot of cluster with its version, expires
+    time and instances, None if there is none
+    '''
+    if not STATE_TABLE:
+        snapshot = local_snapshots.get(cluster)
+        return json.loads(json.dumps(snapshot)) if snapshot else None
+
+    item = client('dynamodb').get_item(TableName=STATE_TABLE,
+                                       Key={'cluster': {'S': cluster}},
+                                       ConsistentRead=True).get('Item')
+    if item is None:
+        return None
+    return {'version': int(item['version']['N']),
+            'expires': float(item['expires']['N']),
+            'instances': json.loads(item['instances']['S'])}
+
+
+def write_snapshot(cluster, snapshot, version):
+    '''
+    replace the shared snapshot of cluster if it is still at version,
+    0 for no snapshot, and bump the version
+
+    rtype: bool, False if another function wrote first
+    '''
+    if not STATE_TABLE:
+        current = local_snapshots.get(cluster)
+        if (current['version'] if current else 0) != version:
+            return False
+        snapshot['version'] = version + 1
+        local_snapshots[cluster] = json.loads(json.dumps(snapshot))
+        return True
+
+    try:
+        client('dynamodb').put_item(
+            TableName=STATE_TABLE,
+            Item={'cluster': {'S': cluster},
+                  'version': {'N': str(version + 1)},
+                  'expires': {'N': repr(snapshot['expires'])},
+                  'instances': {'S': json.dumps(snapshot['instances'])}},
+            ConditionExpression='attribute_not_exists(#v) OR #v = :v',
+            ExpressionAttributeNames={'#v': 'version'},
+            ExpressionAttributeValues={':v': {'N': str(version)}})
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+    snapshot['version'] = version + 1
+    return True
+
+
+def get_snapshot(cluster, fresh=False):
+    '''
+    read the shared snapshot of cluster, describing the cluster again if it
+    is expired, or always if fresh
+
+    rtype: dict
+    '''
+    snapshot = read_snapshot(cluster)
+    if snapshot is not None and not fresh and snapshot['expires'] > time():
+        return snapshot
+
+    version = snapshot['version'] if snapshot else 0
+    snapshot = {'expires': time() + SNAPSHOT_TTL,
+                'instances': describe_cluster(cluster)}
+    if not write_snapshot(cluster, snapshot, version):
+        # another function described the cluster at the same time
+        snapshot = read_snapshot(cluster)
+    return snapshot
+
+
+def choose_instance(instances, cpu, memory):
+    '''
+    choose the container instance of INSTANCE_TYPES to place a task by
+    PLACEMENT_STRATEGY: bestfit leaves the least CPU and memory unused,
+    relative to the instance size; binpack the least memory; spread the most
+    memory.
+
+    rtype: dict, None if no instance has enough resources
+    '''
+    best = None
+    best_score = None
+    for instance in instances:
+        if instance['type'] not in INSTANCE_TYPES or \
+                not instance['connected']:
+            continue
+        left_cpu = instance['cpu'] - cpu
+        left_memory = instance['memory'] - memory
+        if left_cpu < 0 or left_memory < 0:
+            continue
+
+        if PLACEMENT_STRATEGY == 'spread':
+            score = -left_memory
+        elif PLACEMENT_STRATEGY == 'binpack':
+            score = left_memory
+        else:
+            score = float(left_cpu) / max(instance['total_cpu'], 1) + \
+                float(left_memory) / max(instance['total_memory'], 1)
+        if best is None or score < best_score:
+            best = instance
+            best_score = score
+    return best
+
+
+def plan_tasks(cluster, count, fresh=False):
+    '''
+    choose container instances for up to count tasks on the shared snapshot
+    and write the resources they take back to it, planning again on the
+    newer snapshot if another function placed tasks in between.
+
+    rtype: tuple, container instance arn of each task placed and the
+    snapshot instances
+    '''
+    for _ in range(SNAPSHOT_RETRIES):
+        snapshot = get_snapshot(cluster, fresh)
+        fresh = False
+        plan = []
+        for _ in range(count):
+            instance = choose_instance(snapshot['instances'], TASK_CPU,
+                                       TASK_MEMORY)
+            if instance is None:
+                break
+            instance['cpu'] -= TASK_CPU
+            instance['memory'] -= TASK_MEMORY
+            plan.append(instance['arn'])
+        if not plan or write_snapshot(cluster, snapshot,
+                                      snapshot['version']):
+            return plan, snapshot['instances']
+        print('snapshot changed while placing, plan again')
+    # ECS rejects the tasks that no longer fit
+    return plan, snapshot['instances']
 
-    return arns
 
 def _is_cluster_exist(cluster_name):
     """Test if cluster with the name :param cluster_name:
@@ -52,7 +317,7 @@ def _is_cluster_exist(cluster_name):
     response. Must check if the status is 'ACTIVE' or 'INACTIVE'
     for actual existence.
     """
-    response = ecs.describe_clusters(clusters=[cluster_name,]) # Test this; might throw exception; if so, use ListClusters function 
+    response = client('ecs').describe_clusters(clusters=[cluster_name,]) # Test this; might throw exception; if so, use ListClusters function 
     exists = False
     if response is not None and 'clusters' in response:
         for entry in response['clusters']:
@@ -67,99 +332,231 @@ def is_cluster_exist(cluster_name):
     The response contains the ARNs of all created clusters 
     (by region) in the user's account 
     """    
-    response = ecs.list_clusters()
+    response = client('ecs').list_clusters()
     for clusterArn in response['clusterArns']:
         if (clusterArn.split(":")[-1]).split("/")[-1] == 'default':
             return True
     while response.get('nextToken', None) is not None:
-        response = ecs.list_clusters(nextToken=response['nextToken'])
+        response = client('ecs').list_clusters(nextToken=response['nextToken'])
         for clusterArn in response['clusterArns']:
             if (clusterArn.split(":")[-1]).split("/")[-1] == 'default':
                 return True
     return False
 
-def start_task(cluster, memory):
+def start_task(cluster, count=1, fresh=False):
     '''
-    given a cluster and task required memory, return true if successfully start
-    task.
+    place up to count tasks on container instances of the wanted instance
+    type, planned by plan_tasks() on the shared snapshot of the cluster.
+
+    rtype: int, number of tasks started
     '''
     #if not is_cluster_exist(cluster):
-        #res = ecs.create_cluster(clusterName=cluster)
-        
-    global ec2InstanceId
-    ec2_started = False
-    arns = get_instances_arns(cluster)
-    if arns:
-        ins = ecs.describe_container_instances(
-            cluster=cluster, containerInstances=arns)['containerInstances']
-        for inc in ins:
-            info = ec2.describe_instances(InstanceIds=[inc['ec2InstanceId']])
-            if info['Reservations'][0]['Instances'][0]['InstanceType'] != '%(instance_type)s':
-                instances.add(inc['containerInstanceArn'])
-            else:
-                if inc['ec2InstanceId'] == ec2InstanceId:
-                    ec2_started = True
-                if inc['remainingResources'] >= memory:
-                    res = ecs.start_task(
-                        taskDefinition='%(task_name)s',
-                        containerInstances=[inc['containerInstanceArn']])
-                    if len(res['failures']) == 0:
-                        print('start task at {}'.format(inc['containerInstanceArn']))
-                        return True
-    if ec2_started:
-        ec2InstanceId = create_ec2()
-        print('created ec2 has been used, start new ec2')
-    return False
+        #res = client('ecs').create_cluster(clusterName=cluster)
+
+    plan, instances = plan_tasks(cluster, count, fresh)
+
+    # one call starts one task on each listed instance
+    started = 0
+    while plan:
+        batch = []
+        for arn in plan:
+            if arn not in batch and len(batch) < START_TASK_LIMIT:
+                batch.append(arn)
+        for arn in batch:
+            plan.remove(arn)
+        res = client('ecs').start_task(cluster=cluster,
+                                       taskDefinition='%(task_name)s',
+                                       containerInstances=batch)
+        started += len(res['tasks'])
+        for task in res['tasks']:
+            print('start task at {}'.format(task['containerInstanceArn']))
+        if res['failures']:
+            print('failed to start task: {}'.format(
+                [f.get('reason') for f in res['failures']]))
+            failed = [f.get('arn') for f in res['failures']]
+            plan = [arn for arn in plan if arn not in failed]
+
+    for instance in instances:
+        launched.pop(instance['ec2'], None)
+    return started
+
+
+def start_provisioned_tasks(cluster, count):
+    '''
+    run count tasks on CAPACITY_PROVIDER. ECS keeps them in PROVISIONING
+    until managed scaling adds instances for them.
+
+    rtype: int, number of tasks started
+    '''
+    started = 0
+    while started < count:
+        res = client('ecs').run_task(
+            cluster=cluster, taskDefinition='%(task_name)s',
+            count=min(RUN_TASK_LIMIT, count - started),
+            capacityProviderStrategy=[{'capacityProvider': CAPACITY_PROVIDER,
+                                       'weight': 1}])
+        started += len(res['tasks'])
+        if res['failures']:
+            print('failed to run task: {}'.format(
+                [f.get('reason') for f in res['failures']]))
+            break
+    return started
+
+
+def wait_for_placement(cluster, count, deadline):
+    '''
+    retry start_task with jittered exponential backoff until count tasks are
+    placed or time() passes deadline. Each retry describes the cluster
+    again to see the instances joined.
+
+    rtype: int, number of tasks started
+    '''
+    started = 0
+    delay = PLACEMENT_BASE_DELAY
+    while started < count:
+        pause = random.uniform(0, delay)
+        if time() + pause >= deadline:
+            break
+        sleep(pause)
+        started += start_task(cluster, count - started, fresh=True)
+        delay = min(PLACEMENT_MAX_DELAY, delay * 2)
+    return started
+
+
+def get_instance_size(instance_type):
+    '''
+    rtype: tuple, CPU units and MB of memory tasks can use on instance_type
+    '''
+    if instance_type not in instance_sizes:
+        info = client('ec2').describe_instance_types(
+            InstanceTypes=[instance_type])['InstanceTypes'][0]
+        memory = info['MemoryInfo']['SizeInMiB'] * (1 - INSTANCE_OVERHEAD)
+        instance_sizes[instance_type] = (
+            info['VCpuInfo']['DefaultVCpus'] * 1024, int(memory))
+    return instance_sizes[instance_type]
+
+
+def instances_needed(instance_type, count):
+    '''
+    rtype: int, instances of instance_type holding count tasks
+    '''
+    cpu, memory = get_instance_size(instance_type)
+    per_instance = max(1, min(cpu // max(TASK_CPU, 1), memory // TASK_MEMORY))
+    return int(math.ceil(float(count) / per_instance))
 
 
-def create_ec2():
+def create_ec2(count):
     '''
-    add ec2 machine into ecs default cluster and add cloudwatch shut down
-    :rtype: string
+    add ec2 machines holding count tasks into ecs default cluster and add
+    cloudwatch shut down. Instance types are tried in order of INSTANCE_TYPES
+    until one has capacity.
+
+    :rtype: list, launched instance ids
     '''
     # add ec2 machine into ecs default cluster
-    ec2 = boto3.resource('ec2')
-    instances = ec2.create_instances(ImageId='%(image_id)s', MinCount=1,
-                                     KeyName='%(key_pair)s', MaxCount=1,
-                                     #FIXME SecurityGroups=['%(security_group)s'],
-                                     InstanceType='%(instance_type)s',
-                                     SubnetId='%(subnet_id)s',
-                                     IamInstanceProfile={'Name': '%(iam_name)s'})
-
-    # register instances for cloudwatch shutdown
-    alarm_name = instances[0].id + '-shutdown'
-    alarm_act = ['arn:aws:swf:%(region)s:%(account_id)s:action/actions/AWS_EC2.InstanceId.Terminate/1.0']
-    dimension = [{"Name": "InstanceId", "Value": instances[0].id}]
-    cw.put_metric_alarm(AlarmName=alarm_name, AlarmActions=alarm_act,
-                        MetricName='CPUUtilization', Namespace='AWS/EC2',
-                        Statistic='Average', Dimensions=dimension, Period=300,
-                        EvaluationPeriods=2,
-                        Threshold=1, ComparisonOperator='LessThanThreshold')
-
-    # send the cloudwatch name and instance id for cleanup
-    message = {}
-    message['alarm_name'] = alarm_name
-    message['ec2InstanceId'] = instances[0].id
-    sqs.send_message(QueueUrl='%(alarm_sqs)s', MessageBody=json.dumps(message))
-    return instances[0].id
+    ec2_resource = boto3.resource('ec2')
+    instances = []
+    for instance_type in INSTANCE_TYPES:
+        number = instances_needed(instance_type, count)
+        try:
+            instances = ec2_resource.create_instances(
+                ImageId='%(image_id)s', MinCount=1,
+                KeyName='%(key_pair)s', MaxCount=number,
+                #FIXME SecurityGroups=['%(security_group)s'],
+                InstanceType=instance_type,
+                SubnetId='%(subnet_id)s',
+                IamInstanceProfile={'Name': '%(iam_name)s'})
+            print('launch {} {} instances'.format(len(instances),
+                                                  instance_type))
+            break
+        except ClientError as err:
+            if err.response['Error']['Code'] not in CAPACITY_ERRORS:
+                raise
+            print('no capacity of {}: {}'.format(instance_type, err))
+
+    for instance in instances:
+        # register instances for cloudwatch shutdown
+        alarm_name = instance.id + '-shutdown'
+        alarm_act = ['arn:aws:swf:%(region)s:%(account_id)s:action/actions/AWS_EC2.InstanceId.Terminate/1.0']
+        dimension = [{"Name": "InstanceId", "Value": instance.id}]
+        client('cloudwatch').put_metric_alarm(
+            AlarmName=alarm_name, AlarmActions=alarm_act,
+            MetricName='CPUUtilization', Namespace='AWS/EC2',
+            Statistic='Average', Dimensions=dimension,
+            Period=300, EvaluationPeriods=2,
+            Threshold=1,
+            ComparisonOperator='LessThanThreshold')
+
+        # send the cloudwatch name and instance id for cleanup
+        message = {}
+        message['alarm_name'] = alarm_name
+        message['ec2InstanceId'] = instance.id
+        client('sqs').send_message(QueueUrl='%(alarm_sqs)s',
+                                   MessageBody=json.dumps(message))
+    return [instance.id for instance in instances]
 
 
 def lambda_handler(event, context):
+    global init_seconds
     start_time = time()
     # print("Received event: " + json.dumps(event, indent=2))
+    try:
+        return handle(event, context, start_time)
+    finally:
+        # init_seconds is only kept for the first invocation of a container
+        if init_seconds is not None:
+            print('cold start init {} s'.format(init_seconds))
+            init_seconds = None
+        print('handler {:.3f} s, memory {} MB'.format(
+            time() - start_time, context.memory_limit_in_mb))
+
+
+def handle(event, context, start_time):
+    # invoked by setup-pipe to measure the cold start
+    if event.get('yunpipe') == 'probe':
+        return 'probe'
+
+    # result cache index and run profiles are not input files
+    records = [r for r in event.get('Records', [])
+               if not r['s3']['object']['key'].startswith(
+                   ('.yunpipe-cache/', '.yunpipe-profile/'))]
+    if 'Records' in event and not records:
+        return 'skip result cache index and profiles'
 
     QueueUrl = '%(sqs)s'
-    sqs.send_message(QueueUrl=QueueUrl, MessageBody=json.dumps(event))
+    client('sqs').send_message(QueueUrl=QueueUrl, MessageBody=json.dumps(event))
 
     print('run time {}'.format((time() - start_time)))
-    # start task at given type of instance
-    if not start_task('default', %(memory)s):
+    count = tasks_needed('default')
+    if count == 0:
+        return 'send messages to sqs, enough ecs tasks running'
+
+    # start tasks at given type of instance
+    started = start_task('default', count)
+    for instance_id, launch_time in list(launched.items()):
+        if time() - launch_time > LAUNCH_TIMEOUT:
+            del launched[instance_id]
+    if started < count and CAPACITY_PROVIDER:
+        started += start_provisioned_tasks('default', count - started)
+    elif started < count and not launched:
+        # otherwise instances still joining will take the rest
         print('first check run time {}'.format((time() - start_time)))
-        ec2InstanceId = create_ec2()
+        for instance_id in create_ec2(count - started):
+            launched[instance_id] = time()
         print('run time {}'.format((time() - start_time)))
 
-        while not start_task('default', %(memory)s):
-            pass
+    if started == 0 and launched:
+        deadline = time() + \
+            context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN
+        started = wait_for_placement('default', count, deadline)
+    if started == 0:
+        # the file stays on the queue for the next task started
+        print('no capacity before deadline, defer file on queue')
+        return 'send messages to sqs and defer ecs task'
+    print('started {} of {} tasks'.format(started, count))
 
     print('run time {}'.format((time() - start_time)))
     return 'send messages to sqs and start ecs'
+
+
+init_seconds = round(time() - init_start, 3)
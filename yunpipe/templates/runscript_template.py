@@ -1,12 +1,45 @@
 import json
 import os
 import logging
-from subprocess import call
+from subprocess import Popen
+from subprocess import PIPE
+import time
+from time import sleep
+from time import monotonic
+from collections import deque
+from collections import OrderedDict
+from queue import Queue
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+from threading import Thread
+from threading import Event
+from threading import Lock
+from tempfile import mkdtemp
+from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj
+from shutil import rmtree
+from urllib.parse import unquote_plus
+from urllib.request import urlopen
+from hashlib import sha256
+from datetime import datetime
+import struct
+import fcntl
+from uuid import uuid4
+import tarfile
+import zlib
 import traceback
 
 import boto3.session
+from boto3.s3.transfer import TransferConfig
 import botocore.exceptions
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # TODO: need to check folder
 
 # user specified environment variable
@@ -22,6 +55,100 @@ NAME = os.getenv('NAME', default='%(name)s')
 INPUT_PATH = '%(input)s'
 OUTPUT_PATH = '%(output)s'
 
+# run command of the algorithm. $stdin / $stdout stream the S3 objects
+# through the program instead of $input / $output files on disk
+COMMAND = '%(command)s'
+STREAM_INPUT = '$stdin' in COMMAND.split()
+STREAM_OUTPUT = '$stdout' in COMMAND.split()
+# $inputs / $output_dir run the program once over a batch of files
+BATCH_MODE = '$inputs' in COMMAND.split()
+
+# resource profile of each run, uploaded every STATS_INTERVAL seconds as
+# JSON lines under PROFILE_PREFIX of the output bucket, see profile_log
+PROFILE_PREFIX = '.yunpipe-profile/'
+PROFILE_FIELDS = ['peak_rss_mb', 'cpu_seconds', 'wall_seconds']
+
+# per file metrics, one JSON line for each file written to stdout, a local
+# file or stdout in CloudWatch embedded metric format, see emit_metrics()
+METRICS_OUTPUT = os.getenv('METRICS_OUTPUT', default='stdout')
+METRICS_FILE = os.getenv('METRICS_FILE',
+                         default=OUTPUT_PATH + 'yunpipe-metrics.jsonl')
+METRICS_NAMESPACE = 'yunpipe'
+
+# a task of an ecs service keeps polling its queue once drained instead of
+# exiting, ECS stops it when the service scales in
+SERVICE_MODE = os.getenv('SERVICE_MODE', default='False') == 'True'
+
+# SQS long polling, see receive_messages()
+WAIT_TIME_SECONDS = 20
+MAX_NUMBER_OF_MESSAGES = 10
+MAX_BACKOFF = 64
+
+# messages stay invisible while their files are processed, extended by a
+# heartbeat every HEARTBEAT_INTERVAL seconds, see message_tracker
+VISIBILITY_TIMEOUT = int(os.getenv('VISIBILITY_TIMEOUT', default='120'))
+HEARTBEAT_INTERVAL = max(1, VISIBILITY_TIMEOUT // 3)
+
+# task resources, set by the task definition. TASK_CPU and FILE_CPU
+# (reserved for one run of the algorithm) are in cpu units, TASK_MEMORY and
+# FILE_MEMORY in MB
+TASK_CPU = int(os.getenv('TASK_CPU', default='0'))
+FILE_CPU = int(os.getenv('FILE_CPU', default='0'))
+TASK_MEMORY = int(os.getenv('TASK_MEMORY', default='0'))
+FILE_MEMORY = int(os.getenv('FILE_MEMORY', default='0'))
+
+# download / upload threads and how often to log pipeline statistics
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', default='2'))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', default='2'))
+STATS_INTERVAL = int(os.getenv('STATS_INTERVAL', default='60'))
+
+MB = 1024 * 1024
+
+# multipart transfer settings, chunk size in MB. Auto tuned from object size
+# and instance network class if not set, see get_transfer_config()
+S3_CHUNK_SIZE = int(os.getenv('S3_CHUNK_SIZE', default='0')) * MB
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', default='0'))
+INSTANCE_TYPE = os.getenv('INSTANCE_TYPE', default='')
+
+# concurrent multipart requests per instance for each network class
+NETWORK_CONCURRENCY = {'low': 4, 'moderate': 8, 'high': 16, 'very high': 32}
+MIN_CHUNK_SIZE = 8 * MB
+MAX_CHUNK_SIZE = 512 * MB
+MAX_PARTS = 10000
+# parts of a stream of unknown size double every PARTS_PER_SIZE parts up
+# to MAX_PART_SIZE, so MAX_PARTS parts hold S3's largest object
+PARTS_PER_SIZE = 1000
+MAX_PART_SIZE = 5 * 1024 * MB
+
+# bytes read from S3 at a time when streaming into $stdin
+STREAM_READ_SIZE = MB
+
+# result cache, see get_cache_key(). Index objects are kept under
+# CACHE_PREFIX of the output bucket, the lambda function ignores them too
+RESULT_CACHE = os.getenv('RESULT_CACHE', default='True') == 'True'
+CACHE_PREFIX = '.yunpipe-cache/'
+ALGORITHM_IMAGE = os.getenv('ALGORITHM_IMAGE', default=NAME)
+ALGORITHM_VARIABLES = os.getenv('ALGORITHM_VARIABLES', default='')
+CACHE_METADATA = 'yunpipe-cache-key'
+
+# local input cache in MB, 0 turns it off, see input_cache. FICLONE is
+# the linux ioctl making a reflink, see copy_file()
+INPUT_CACHE_SIZE = int(os.getenv('INPUT_CACHE_SIZE', default='1024')) * MB
+INPUT_CACHE_PATH = INPUT_PATH + '.yunpipe-cache/'
+FICLONE = 0x40049409
+
+# archive format and compression level of folder results, see
+# upload_archive(). Members are compressed by ARCHIVE_THREADS threads
+ARCHIVE_EXTENSION = {'zip': '.zip', 'tar': '.tar', 'tar.zst': '.tar.zst'}
+ARCHIVE_DEFAULT_LEVEL = {'zip': 6, 'tar': 0, 'tar.zst': 3}
+ARCHIVE_FORMAT = os.getenv('ARCHIVE_FORMAT', default='zip')
+ARCHIVE_LEVEL = int(os.getenv('ARCHIVE_LEVEL', default=str(
+    ARCHIVE_DEFAULT_LEVEL.get(ARCHIVE_FORMAT, 0))))
+ARCHIVE_THREADS = int(os.getenv('ARCHIVE_THREADS', default=str(
+    max(1, (os.cpu_count() or 1) // max(1, UPLOAD_WORKERS)))))
+# compressed members bigger than this are spooled to disk
+ARCHIVE_SPOOL_SIZE = 64 * MB
+
 
 logger = logging.getLogger()
 log_lvl = os.getenv('LOG_LVL', default='WARNING')
@@ -35,7 +162,16 @@ elif log_lvl == 'DEBUG':
 else:
     logger.setLevel(logging.WARNING)
 
-logger.addHandler(logging.StreamHandler())
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter('{threadName} {message}', style='{'))
+logger.addHandler(handler)
+
+if ARCHIVE_FORMAT not in ARCHIVE_EXTENSION:
+    logger.warn('unknown archive format {}, use zip'.format(ARCHIVE_FORMAT))
+    ARCHIVE_FORMAT = 'zip'
+if ARCHIVE_FORMAT == 'tar.zst' and zstandard is None:
+    logger.warn('zstandard is not installed, archive results as tar')
+    ARCHIVE_FORMAT = 'tar'
 
 
 session = boto3.session.Session(region_name=REGION)
@@ -43,149 +179,1593 @@ sqs = session.client('sqs')
 s3 = session.client('s3')
 
 
-def pull_files(message_URL):
+def get_worker_number():
+    '''
+    number of files processed concurrently in this container. Use WORKERS if
+    set, otherwise as many as both the task cpu and memory reserved for
+    them allow. Without FILE_CPU, the cpus of the host are counted instead.
+
+    rtype: int
+    '''
+    workers = os.getenv('WORKERS')
+    if workers:
+        return max(1, int(workers))
+
+    if TASK_CPU and FILE_CPU:
+        workers = TASK_CPU // FILE_CPU
+    else:
+        workers = os.cpu_count() or 1
+        # cpu units below one core are only a share, do not limit on them
+        if TASK_CPU >= 1024:
+            workers = min(workers, TASK_CPU // 1024)
+    if TASK_MEMORY and FILE_MEMORY:
+        workers = min(workers, TASK_MEMORY // FILE_MEMORY)
+    return max(1, workers)
+
+
+WORKERS = get_worker_number()
+
+# batch mode gathers up to BATCH_SIZE files for one run, waiting at most
+# BATCH_WAIT seconds for them
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', default='10')) if BATCH_MODE else 1
+BATCH_WAIT = float(os.getenv('BATCH_WAIT', default='5'))
+
+# files waiting between two stages, enough to keep every worker busy
+QUEUE_SIZE = int(os.getenv('QUEUE_SIZE', default=str(WORKERS * BATCH_SIZE)))
+
+
+def receive_messages(message_URL):
     '''
-    pull message form message_URL
+    long poll message_URL for up to MAX_NUMBER_OF_MESSAGES messages. Back off
+    exponentially on errors instead of retrying at once.
+
+    rtype: list
     '''
-    msgs = {}
-    while 'Messages' not in msgs:
+    backoff = 1
+    while True:
         logger.debug('pull message from SQS: {}'.format(message_URL))
-        while 'Messages' not in msgs:
-            try:
-                msgs = sqs.receive_message(QueueUrl=message_URL)
-            except botocore.exceptions.ClientError as err:
-                logger.debug(traceback.format_exc())
-                logger.warn(err.response)
-                continue
-            except Exception as err:
-                logger.debug(traceback.format_exc())
-                logger.error('Unexpected error occures at pull_files()!!')
-                logger.error(err)
-                continue
-
-        if '\"Records\"' not in msgs['Messages'][0]['Body']:
-            # delete such message
-            try:
-                sqs.delete_message(QueueUrl=message_URL,
-                                   ReceiptHandle=msgs['Messages'][0]['ReceiptHandle'])
-            except botocore.exceptions.ClientError as err:
-                logger.debug(traceback.format_exc())
-                logger.warn(err.response)
-                sqs.delete_message(QueueUrl=message_URL,
-                                   ReceiptHandle=msgs['Messages'][0]['ReceiptHandle'])
-            except Exception as err:
-                logger.debug(traceback.format_exc())
-                logger.error('Unexpected error occures when delete message!!')
-                logger.error(err)
-            logger.info('delete one useless message from file queue')
-            msgs = {}
-        
-    logger.info('receive file info from SQS')
-    for msg in msgs['Messages']:
-        record = json.loads(msg['Body'])['Records'][0]
-        bucket = record['s3']['bucket']['name']
-        file = record['s3']['object']['key']
-
-        # delete message
         try:
-            sqs.delete_message(QueueUrl=message_URL,
-                               ReceiptHandle=msg['ReceiptHandle'])
+            msgs = sqs.receive_message(
+                QueueUrl=message_URL,
+                MaxNumberOfMessages=MAX_NUMBER_OF_MESSAGES,
+                WaitTimeSeconds=WAIT_TIME_SECONDS,
+                VisibilityTimeout=VISIBILITY_TIMEOUT)
+            return msgs.get('Messages', [])
+        except botocore.exceptions.ClientError as err:
+            logger.debug(traceback.format_exc())
+            logger.warn(err.response)
+        except Exception as err:
+            logger.debug(traceback.format_exc())
+            logger.error('Unexpected error occures at receive_messages()!!')
+            logger.error(err)
+
+        logger.info('retry receiving messages in {} seconds'.format(backoff))
+        sleep(backoff)
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+def delete_messages(message_URL, msgs):
+    '''
+    acknowledge msgs using delete_message_batch, 10 messages per call.
+    '''
+    for i in range(0, len(msgs), MAX_NUMBER_OF_MESSAGES):
+        entries = []
+        for j, msg in enumerate(msgs[i:i + MAX_NUMBER_OF_MESSAGES]):
+            entries.append({'Id': str(j), 'ReceiptHandle': msg['ReceiptHandle']})
+        try:
+            res = sqs.delete_message_batch(QueueUrl=message_URL,
+                                           Entries=entries)
+        except botocore.exceptions.ClientError as err:
+            logger.debug(traceback.format_exc())
+            logger.warn(err.response)
+            continue
+        except Exception as err:
+            logger.debug(traceback.format_exc())
+            logger.error('Unexpected error occures when delete messages!!')
+            logger.error(err)
+            continue
+        for failed in res.get('Failed', []):
+            logger.warn('failed to delete message: {}'.format(failed))
+        logger.info('delete {} messages from file queue'.format(
+            len(res.get('Successful', []))))
+
+
+def change_visibility(message_URL, msgs, timeout):
+    '''
+    set visibility timeout of msgs using change_message_visibility_batch,
+    10 messages per call.
+    '''
+    for i in range(0, len(msgs), MAX_NUMBER_OF_MESSAGES):
+        entries = []
+        for j, msg in enumerate(msgs[i:i + MAX_NUMBER_OF_MESSAGES]):
+            entries.append({'Id': str(j),
+                            'ReceiptHandle': msg['ReceiptHandle'],
+                            'VisibilityTimeout': timeout})
+        try:
+            res = sqs.change_message_visibility_batch(QueueUrl=message_URL,
+                                                      Entries=entries)
         except botocore.exceptions.ClientError as err:
             logger.debug(traceback.format_exc())
             logger.warn(err.response)
-            sqs.delete_message(QueueUrl=message_URL,
-                               ReceiptHandle=msg['ReceiptHandle'])
+            continue
         except Exception as err:
             logger.debug(traceback.format_exc())
-            logger.error('Unexpected error occures when delete message!!')
+            logger.error('Unexpected error occures when change visibility!!')
             logger.error(err)
-        logger.info('delete one message from file queue')
+            continue
+        for failed in res.get('Failed', []):
+            logger.warn('failed to change message visibility: {}'.format(
+                failed))
+
+
+class message_tracker:
+    '''
+    keep track of messages whose files are being processed. A background
+    heartbeat keeps them invisible on the queue. A message is deleted only
+    after every file in it is uploaded; if any of them fails, the message is
+    left to reappear on the queue once its visibility timeout expires, so
+    SQS retries it.
+    '''
+
+    def __init__(self, message_URL):
+        self.message_URL = message_URL
+        self.lock = Lock()
+        # receipt handle -> {'msg', 'left', 'failed'}
+        self.messages = {}
+        self.to_delete = []
+        self.stopped = Event()
+        self.heartbeat = Thread(target=self._heartbeat, name='heartbeat',
+                                daemon=True)
+
+    def start(self):
+        self.heartbeat.start()
+
+    def add(self, msg, files):
+        '''
+        track msg containing files number of files. A message without files
+        is deleted at once.
+        '''
+        with self.lock:
+            if files == 0:
+                self.to_delete.append(msg)
+            else:
+                self.messages[msg['ReceiptHandle']] = {
+                    'msg': msg, 'left': files, 'failed': False}
+
+    def done(self, msg, succeeded=True):
+        '''
+        one file of msg is finished
+        '''
+        with self.lock:
+            entry = self.messages[msg['ReceiptHandle']]
+            entry['left'] -= 1
+            entry['failed'] = entry['failed'] or not succeeded
+            if entry['left'] > 0:
+                return
+            del self.messages[msg['ReceiptHandle']]
+            if entry['failed']:
+                logger.warn('leave message {} on the queue for retry'.format(
+                    msg.get('MessageId')))
+            else:
+                self.to_delete.append(msg)
+            flush = len(self.to_delete) >= MAX_NUMBER_OF_MESSAGES
+        if flush:
+            self.flush()
+
+    def flush(self):
+        '''
+        delete finished messages
+        '''
+        with self.lock:
+            msgs, self.to_delete = self.to_delete, []
+        if msgs:
+            delete_messages(self.message_URL, msgs)
+
+    def extend(self):
+        '''
+        extend visibility timeout of all messages in process
+        '''
+        with self.lock:
+            msgs = [entry['msg'] for entry in self.messages.values()]
+        if msgs:
+            logger.debug('extend visibility of {} messages'.format(len(msgs)))
+            change_visibility(self.message_URL, msgs, VISIBILITY_TIMEOUT)
+
+    def stop(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        self.flush()
+
+    def _heartbeat(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            self.extend()
+            self.flush()
+
 
-        # download file from input S3 bucket
-        input_file = download_file(bucket, file, msg)
-        if input_file == '':
+def parse_records(msg):
+    '''
+    get bucket, key and object info of every record in a S3 event message. Messages which
+    are not S3 events, such as s3:TestEvent, give an empty list.
+
+    rtype: list of dict with bucket, file, size, etag and event time
+    '''
+    try:
+        body = json.loads(msg['Body'])
+    except ValueError:
+        return []
+    if not isinstance(body, dict):
+        return []
+
+    files = []
+    for record in body.get('Records', []):
+        if 's3' not in record:
+            continue
+        obj = record['s3']['object']
+        if unquote_plus(obj['key']).startswith((CACHE_PREFIX, PROFILE_PREFIX)):
             continue
+        files.append({
+            'bucket': record['s3']['bucket']['name'],
+            # object keys in S3 event are url encoded
+            'file': unquote_plus(obj['key']),
+            'size': obj.get('size'),
+            'etag': obj.get('eTag'),
+            'event_time': record.get('eventTime')})
+    return files
+
+
+class input_cache:
+    '''
+    size bounded cache of downloaded input files on local disk, keyed by
+    bucket, key and ETag. The least recently used files are evicted once
+    capacity bytes are exceeded. Files are copied (reflinked where the file
+    system allows) in and out of the cache, so a program changing its input
+    in place never changes the cached file, and evicting never breaks a
+    running job.
+    '''
+
+    def __init__(self, folder, capacity):
+        self.folder = folder
+        self.capacity = capacity
+        self.lock = Lock()
+        # cache key -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self.capacity > 0:
+            rmtree(self.folder, ignore_errors=True)
+            os.makedirs(self.folder)
+
+    def key(self, job):
+        '''
+        rtype: string, None if job cannot be cached
+        '''
+        if self.capacity <= 0 or not job.get('etag'):
+            return None
+        key = json.dumps([job['bucket'], job['file'], job['etag']])
+        return sha256(key.encode()).hexdigest()
+
+    def get(self, key, target):
+        '''
+        copy cached file of key to target
+
+        rtype: boolean, True if cached
+        '''
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            # an open file outlives its eviction
+            source = open(self.folder + key, 'rb')
+        with source:
+            copy_file(source, target)
+        return True
+
+    def put(self, key, path):
+        '''
+        add downloaded file path into the cache, evicting old files
+        '''
+        size = os.path.getsize(path)
+        if size > self.capacity:
+            return
+        tmp_path = self.folder + key + '.' + uuid4().hex
+        try:
+            with open(path, 'rb') as source:
+                copy_file(source, tmp_path)
+        except OSError as err:
+            logger.warn('cannot cache {}: {}'.format(path, err))
+            return
+        with self.lock:
+            if key in self.entries:
+                os.remove(tmp_path)
+                return
+            while self.size + size > self.capacity:
+                old, old_size = self.entries.popitem(last=False)
+                os.remove(self.folder + old)
+                self.size -= old_size
+            os.replace(tmp_path, self.folder + key)
+            self.entries[key] = size
+            self.size += size
+
+    def stats(self):
+        '''
+        rtype: dict
+        '''
+        with self.lock:
+            return {'files': len(self.entries), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class profile_log:
+    '''
+    resource profiles of finished runs, flushed into one S3 object of JSON
+    lines at a time. profile-algorithm aggregates them to suggest memory and
+    cpu of the algorithm.
+    '''
+
+    def __init__(self):
+        self.task = uuid4().hex
+        self.profiles = []
+        self.lock = Lock()
+
+    def add(self, job):
+        if 'peak_rss_mb' not in job['metrics']:
+            return
+        profile = {'algorithm': NAME, 'key': job['file'],
+                   'size': job.get('size'), 'workers': WORKERS,
+                   'task_cpu': TASK_CPU, 'task_memory': TASK_MEMORY}
+        for name in PROFILE_FIELDS + ['exit_code', 'batch_size']:
+            if name in job['metrics']:
+                profile[name] = job['metrics'][name]
+        with self.lock:
+            self.profiles.append(profile)
+
+    def flush(self):
+        with self.lock:
+            profiles, self.profiles = self.profiles, []
+        if not profiles:
+            return
+        key = '{}{}/{}-{}.jsonl'.format(PROFILE_PREFIX, NAME,
+                                        int(time.time()), self.task)
+        body = ''.join(json.dumps(p, sort_keys=True) + '\n' for p in profiles)
+        try:
+            s3.put_object(Bucket=UPLOADBUCKET, Key=key, Body=body.encode())
+        except Exception as err:
+            logger.warn('failed to upload {} profiles: {}'.format(
+                len(profiles), err))
+
+
+def copy_file(source, target):
+    '''
+    copy open file source to path target, as a reflink sharing its blocks
+    if the file system supports it (btrfs, xfs), otherwise byte by byte
+    '''
+    with open(target, 'wb') as out:
+        try:
+            fcntl.ioctl(out.fileno(), FICLONE, source.fileno())
+            return
+        except OSError:
+            pass
+        source.seek(0)
+        copyfileobj(source, out, MB)
+
+
+profiles = profile_log()
+inputs = input_cache(INPUT_CACHE_PATH, INPUT_CACHE_SIZE)
+
+
+class stage:
+    '''
+    one stage of the download / run / upload pipeline. Its worker threads
+    take jobs from inbox, call func on them and put the returned job into
+    outbox. A job fails if func returns None or raises. on_done is called
+    with jobs finishing the last stage, on_fail with failed jobs.
+
+    With batch_size above 1, func takes a list of up to batch_size jobs,
+    gathered for at most batch_wait seconds, and returns a list of results.
+    '''
+    STOP = None
+
+    def __init__(self, name, func, workers, inbox, outbox=None,
+                 on_done=None, on_fail=None, batch_size=1, batch_wait=0):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.inbox = inbox
+        self.outbox = outbox
+        self.on_done = on_done
+        self.on_fail = on_fail
+        self.threads = []
+
+        # statistics
+        self.lock = Lock()
+        self.busy = 0
+        self.busy_time = 0.0
+        self.processed = 0
+        self.start_time = monotonic()
+
+    def start(self):
+        self.start_time = monotonic()
+        for i in range(self.workers):
+            thread = Thread(target=self._run,
+                            name='{}-{}'.format(self.name, i))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        '''
+        wait for every job in inbox to finish, then stop all threads
+        '''
+        for _ in self.threads:
+            self.inbox.put(self.STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            job = self.inbox.get()
+            if job is self.STOP:
+                return
+
+            jobs, stop = self._gather(job)
+            self._process(jobs)
+            if stop:
+                return
+
+    def _gather(self, job):
+        '''
+        collect up to batch_size jobs starting with job
+
+        rtype: tuple, list of jobs and whether STOP is received
+        '''
+        jobs = [job]
+        deadline = monotonic() + self.batch_wait
+        while len(jobs) < self.batch_size:
+            try:
+                job = self.inbox.get(timeout=max(0, deadline - monotonic()))
+            except Empty:
+                break
+            if job is self.STOP:
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    def _process(self, jobs):
+        with self.lock:
+            self.busy += 1
+        start = monotonic()
+        try:
+            if self.batch_size > 1:
+                results = self.func(jobs)
+            else:
+                results = [self.func(jobs[0])]
+        except Exception as err:
+            logger.debug(traceback.format_exc())
+            logger.error('Unexpected error occures at {} stage for {}!!'
+                         .format(self.name,
+                                 ', '.join(job['file'] for job in jobs)))
+            logger.error(err)
+            results = [None] * len(jobs)
+        with self.lock:
+            self.busy -= 1
+            self.busy_time += monotonic() - start
+            self.processed += len(jobs)
+
+        for job, result in zip(jobs, results):
+            if result is None:
+                if self.on_fail is not None:
+                    self.on_fail(job)
+            elif self.outbox is not None:
+                self.outbox.put(result)
+            elif self.on_done is not None:
+                self.on_done(result)
+
+    def stats(self):
+        '''
+        rtype: dict
+        '''
+        with self.lock:
+            elapsed = monotonic() - self.start_time
+            occupancy = self.busy_time / (elapsed * self.workers) \
+                if elapsed > 0 else 0.0
+            return {'workers': self.workers, 'busy': self.busy,
+                    'processed': self.processed,
+                    'occupancy': round(occupancy, 3),
+                    'queue': self.inbox.qsize()}
+
+
+class pipeline:
+    '''
+    three stages connected by bounded queues: the next input downloads while
+    the current one runs and the previous result uploads.
+    '''
+
+    def __init__(self, messages):
+        '''
+        para: messages: tracker told when each job succeeds or fails
+        type: message_tracker
+        '''
+        download_queue = Queue(maxsize=QUEUE_SIZE)
+        run_queue = Queue(maxsize=QUEUE_SIZE)
+        upload_queue = Queue(maxsize=QUEUE_SIZE)
+
+        def on_done(job):
+            remove_scratch_folders(job)
+            profiles.add(job)
+            emit_metrics(job, 'cached' if job.get('cached') else 'ok')
+            messages.done(job['msg'])
+
+        def on_fail(job):
+            remove_scratch_folders(job)
+            profiles.add(job)
+            emit_metrics(job, 'failed')
+            messages.done(job['msg'], succeeded=False)
+
+        self.stages = [
+            stage('download', download_stage, DOWNLOAD_WORKERS,
+                  download_queue, run_queue, on_fail=on_fail),
+            stage('run', run_batch_stage if BATCH_MODE else run_stage,
+                  WORKERS, run_queue, upload_queue, on_fail=on_fail,
+                  batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT),
+            stage('upload', upload_stage, UPLOAD_WORKERS, upload_queue,
+                  on_done=on_done, on_fail=on_fail)]
+        self.finished = Event()
+        self.monitor = Thread(target=self._log_stats, name='monitor',
+                              daemon=True)
+
+    def start(self):
+        for s in self.stages:
+            s.start()
+        self.monitor.start()
+
+    def put(self, job):
+        '''
+        add a job, block while the download queue is full
+        '''
+        self.stages[0].inbox.put(job)
+
+    def join(self):
+        '''
+        finish every job, stopping stages in order
+        '''
+        for s in self.stages:
+            s.stop()
+        self.finished.set()
+        profiles.flush()
+        logger.info('pipeline statistics: {}'.format(json.dumps(self.stats())))
+        logger.info('input cache statistics: {}'.format(
+            json.dumps(inputs.stats())))
+
+    def stats(self):
+        '''
+        queue depth and occupancy of each stage. The stage with the highest
+        occupancy is the bottleneck.
+
+        rtype: dict
+        '''
+        return {s.name: s.stats() for s in self.stages}
+
+    def _log_stats(self):
+        while not self.finished.wait(STATS_INTERVAL):
+            profiles.flush()
+            logger.info('pipeline statistics: {}'.format(
+                json.dumps(self.stats())))
+
+
+def pull_files(message_URL):
+    '''
+    pull messages from message_URL into a local prefetch buffer and feed the
+    files in them into the pipeline. Return once the queue is drained and
+    every file is processed, or after one empty long poll, so that a task
+    finding the queue drained exits and frees its place on the cluster.
+    Messages are deleted only after their files are uploaded.
+    '''
+    prefetch = deque()
+
+    msgs = receive_messages(message_URL)
+    if not msgs:
+        logger.info('no message on the queue')
+        return
+
+    messages = message_tracker(message_URL)
+    messages.start()
+    files = pipeline(messages)
+    files.start()
+    while msgs:
+        logger.info('receive {} messages from SQS'.format(len(msgs)))
+        for msg in msgs:
+            records = parse_records(msg)
+            if not records:
+                logger.info('drop one useless message from file queue')
+            messages.add(msg, len(records))
+            for record in records:
+                record['msg'] = msg
+                record['metrics'] = {}
+                prefetch.append(record)
+
+        while prefetch:
+            files.put(prefetch.popleft())
+
+        msgs = receive_messages(message_URL)
+
+    files.join()
+    messages.stop()
+
+
+def make_scratch_folders():
+    '''
+    create isolated input and output folders for one file under INPUT_PATH
+    and OUTPUT_PATH, so concurrent runs do not overwrite each other.
+
+    rtype: tuple
+    '''
+    input_folder = mkdtemp(prefix='yunpipe-', dir=INPUT_PATH) + '/'
+    output_folder = mkdtemp(prefix='yunpipe-', dir=OUTPUT_PATH) + '/'
+    return input_folder, output_folder
+
+
+def remove_scratch_folders(job):
+    '''
+    remove the scratch folders of a finished job, so long running workers
+    keep a steady disk footprint
+    '''
+    for folder in ('input_folder', 'output_folder'):
+        if folder in job:
+            rmtree(job[folder], ignore_errors=True)
+
+
+def download_stage(job):
+    metrics = job['metrics']
+    metrics['wait_seconds'] = seconds_since(job.get('event_time'))
+
+    # reuse cached result of the same input
+    job['cache_key'] = get_cache_key(job)
+    if job['cache_key'] is not None and copy_cached_result(job):
+        return job
+
+    # download file from input S3 bucket
+    job['input_folder'], job['output_folder'] = make_scratch_folders()
+    if STREAM_INPUT:
+        # read straight from S3 at run stage
+        job['input_file'] = job['input_folder'] + job['file'].split('/')[-1]
+        return job
+    job['input_file'] = job['input_folder'] + job['file'].split('/')[-1]
+    key = inputs.key(job)
+    if key is not None and inputs.get(key, job['input_file']):
+        logger.info('use cached input {}'.format(job['file']))
+        metrics['input_cached'] = True
+        return job
+
+    job['input_file'] = download_file(job['bucket'], job['file'],
+                                      job['input_folder'], job['size'],
+                                      metrics)
+    if job['input_file'] == '':
+        return None
+    if key is not None:
+        inputs.put(key, job['input_file'])
+    return job
+
+
+def run_stage(job):
+    if job.get('cached'):
+        return job
+
+    # run program
+    start = monotonic()
+    if STREAM_INPUT or STREAM_OUTPUT:
+        job['result'] = run_streaming_program(job)
+        job['uploaded'] = STREAM_OUTPUT
+    else:
+        job['result'] = run_program(job['input_file'], job['output_folder'],
+                                    job['metrics'])
+    job['metrics']['run_seconds'] = round(monotonic() - start, 3)
+    if job['result'] == '':
+        return None
+    return job
+
+
+def run_batch_stage(jobs):
+    # run program once for all not cached jobs
+    batch = [job for job in jobs if not job.get('cached')]
+    if batch:
+        start = monotonic()
+        results = run_batch(batch)
+        for job, result in zip(batch, results):
+            job['result'] = result
+            job['metrics']['run_seconds'] = round(monotonic() - start, 3)
+            job['metrics']['batch_size'] = len(batch)
+    return [None if job.get('result') == '' else job for job in jobs]
+
+
+def upload_stage(job):
+    # upload file, $stdout results are uploaded while the program runs
+    if job.get('cached'):
+        return job
+    if not job.get('uploaded'):
+        if os.path.isdir(job['result']):
+            job['result'] = upload_archive(job['result'], job['file'],
+                                           job['cache_key'], job['metrics'])
+            if job['result'] == '':
+                return None
+        elif not upload_file(job['result'], job['file'], job['cache_key'],
+                             job['metrics']):
+            return None
+    if job['cache_key'] is not None:
+        record_cached_result(job, get_result_key(job['result'], job['file']))
+    return job
+
+
+def seconds_since(event_time):
+    '''
+    seconds passed since an S3 event time such as 2016-09-01T12:00:00.000Z
+
+    rtype: float, None if unknown
+    '''
+    if not event_time:
+        return None
+    try:
+        event = datetime.fromisoformat(event_time.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return round(time.time() - event.timestamp(), 3)
+
+
+metrics_lock = Lock()
+
+
+def emit_metrics(job, status):
+    '''
+    write one JSON line of metrics of a finished file to METRICS_OUTPUT:
+    'stdout', 'file' (METRICS_FILE), 'emf' (CloudWatch embedded metric
+    format on stdout, needs the awslogs log driver) or 'none'.
+    '''
+    if METRICS_OUTPUT == 'none':
+        return
+    record = {'algorithm': NAME, 'bucket': job['bucket'], 'key': job['file'],
+              'status': status,
+              'total_seconds': seconds_since(job.get('event_time'))}
+    record.update(job['metrics'])
+
+    if METRICS_OUTPUT == 'emf':
+        names = [name for name, value in sorted(record.items())
+                 if isinstance(value, (int, float)) and
+                 not isinstance(value, bool)]
+        metrics = [{'Name': name,
+                    'Unit': 'Seconds' if name.endswith('_seconds') else
+                    'Bytes' if name.endswith('_bytes') else 'None'}
+                   for name in names if name != 'exit_code']
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE,
+                                   'Dimensions': [['algorithm']],
+                                   'Metrics': metrics}]}
+
+    line = json.dumps(record, sort_keys=True)
+    with metrics_lock:
+        if METRICS_OUTPUT == 'file':
+            with open(METRICS_FILE, 'a') as tmpfile:
+                tmpfile.write(line + '\n')
+        else:
+            print(line, flush=True)
+
+
+def get_image_digest():
+    '''
+    digest of the running image from ECS container metadata, fall back to
+    ALGORITHM_IMAGE
 
-        # run program
-        result = run_program(input_file)
+    rtype: string
+    '''
+    uri = os.getenv('ECS_CONTAINER_METADATA_URI_V4',
+                    default=os.getenv('ECS_CONTAINER_METADATA_URI'))
+    if uri:
+        try:
+            with urlopen(uri, timeout=2) as res:
+                return json.loads(res.read().decode())['ImageID']
+        except Exception as err:
+            logger.debug(traceback.format_exc())
+            logger.warn('cannot get image digest: {}'.format(err))
+    return ALGORITHM_IMAGE
+
+
+IMAGE_DIGEST = get_image_digest() if RESULT_CACHE else ''
+
+
+def get_cache_key(job):
+    '''
+    key of the result cache: same image, command, variables, archive
+    settings and input ETag give the same result.
+
+    rtype: string, None if result cache is off or ETag is unknown
+    '''
+    if not RESULT_CACHE or not job.get('etag'):
+        return None
+    key = json.dumps([IMAGE_DIGEST, COMMAND, ALGORITHM_VARIABLES,
+                      ARCHIVE_FORMAT, ARCHIVE_LEVEL, job['etag']])
+    return sha256(key.encode()).hexdigest()
+
+
+def copy_cached_result(job):
+    '''
+    look up job in the result cache index. On a hit copy the cached result
+    to the result key of job server side, instead of running the program.
+
+    rtype: boolean, True if the cached result is used
+    '''
+    try:
+        res = s3.get_object(Bucket=UPLOADBUCKET,
+                            Key=CACHE_PREFIX + job['cache_key'])
+        entry = json.loads(res['Body'].read().decode())
+        cached_key = entry['key']
+        s3_key = get_result_key(
+            get_cached_result_name(cached_key, entry.get('input', ''),
+                                   job['file']), job['file'])
+        if s3_key == cached_key:
+            s3.head_object(Bucket=UPLOADBUCKET, Key=s3_key)
+        else:
+            s3.copy({'Bucket': UPLOADBUCKET, 'Key': cached_key},
+                    UPLOADBUCKET, s3_key)
+    except botocore.exceptions.ClientError as err:
+        # not cached, or the cached result is gone
+        logger.debug(err.response)
+        return False
+    except Exception as err:
+        logger.debug(traceback.format_exc())
+        logger.warn('cannot use result cache: {}'.format(err))
+        return False
+
+    logger.info('use cached result {} for {}'.format(cached_key, job['file']))
+    job['cached'] = True
+    job['result'] = s3_key
+    return True
+
+
+def get_cached_result_name(cached_key, cached_input, input_file):
+    '''
+    name of the result of input_file copied from cached_key, the result of
+    cached_input. It is named after input_file the way run_program and
+    upload_archive name results, only the extension or archive suffix is
+    taken from cached_key. A result named by the program itself keeps its
+    name.
+
+    rtype: string
+    '''
+    prefix = 'Result-' + NAME + '-'
+    cached_name = cached_key.split('/')[-1]
+    file_name = input_file.split('/')[-1]
+    if not cached_name.startswith(prefix):
+        return cached_name
+    if cached_name == prefix + cached_input.split('/')[-1]:
+        return prefix + file_name
+
+    name = cached_name[len(prefix):]
+    suffix = name[name.index('.'):] if '.' in name else ''
+    return prefix + file_name.split('.')[0] + suffix
+
+
+def record_cached_result(job, s3_key):
+    '''
+    add the uploaded result of job into the result cache index
+    '''
+    entry = {'key': s3_key, 'input': job['bucket'] + '/' + job['file'],
+             'etag': job['etag']}
+    try:
+        s3.put_object(Bucket=UPLOADBUCKET, Key=CACHE_PREFIX + job['cache_key'],
+                      Body=json.dumps(entry).encode())
+    except Exception as err:
+        logger.debug(traceback.format_exc())
+        logger.warn('cannot record result cache: {}'.format(err))
+
+
+def get_network_class(instance_type):
+    '''
+    guess the network performance class of an ec2 instance type from its
+    size, e.g. m4.large is moderate, c4.8xlarge is high and c5n.* is very
+    high.
+
+    rtype: string
+    '''
+    if '.' not in instance_type:
+        return 'moderate'
+    family, size = instance_type.split('.', 1)
+    if family.endswith('n') or size == 'metal':
+        return 'very high'
+    if size in ('nano', 'micro', 'small', 'medium'):
+        return 'low'
+    if size in ('large', 'xlarge'):
+        return 'moderate'
+    if size.endswith('xlarge') and size[:-len('xlarge')].isdigit():
+        if int(size[:-len('xlarge')]) <= 8:
+            return 'high'
+        return 'very high'
+    return 'moderate'
+
+
+def get_transfer_config(size, transfers):
+    '''
+    multipart settings for one object. S3_CHUNK_SIZE and S3_MAX_CONCURRENCY
+    win if set. Otherwise the instance's network concurrency is shared by
+    the transfers running at the same time, and the chunk size gives every
+    thread a few parts while staying under S3's 10000 parts limit.
+
+    para: size: object size in bytes, None if unknown
+    para: transfers: number of transfers running at the same time
+
+    rtype: boto3.s3.transfer.TransferConfig
+    '''
+    concurrency = S3_MAX_CONCURRENCY
+    if not concurrency:
+        network = NETWORK_CONCURRENCY[get_network_class(INSTANCE_TYPE)]
+        concurrency = max(2, network // max(1, transfers))
+
+    chunk_size = S3_CHUNK_SIZE
+    if not chunk_size:
+        size = size or 0
+        chunk_size = min(MAX_CHUNK_SIZE, size // (concurrency * 4))
+        chunk_size = max(MIN_CHUNK_SIZE, chunk_size, -(-size // MAX_PARTS))
+        # round up to whole MB
+        chunk_size = -(-chunk_size // MB) * MB
 
-        # upload file
-        upload_file(result, file)
+    return TransferConfig(multipart_threshold=chunk_size,
+                          multipart_chunksize=chunk_size,
+                          max_concurrency=concurrency, use_threads=True)
 
 
-def download_file(bucket, file, msg):
+def log_transfer(direction, key, size, seconds, config):
+    '''
+    log throughput of one transfer with the settings used, so that they can
+    be tuned from data.
+
+    rtype: dict
+    '''
+    stats = {'transfer': direction, 'key': key, 'bytes': size,
+             'seconds': round(seconds, 3),
+             'MBps': round(size / MB / seconds, 2) if seconds > 0 else None,
+             'chunk_size': config.multipart_chunksize,
+             'max_concurrency': config.max_concurrency,
+             'instance_type': INSTANCE_TYPE}
+    logger.info('transfer statistics: {}'.format(json.dumps(stats)))
+    return stats
+
+
+def download_file(bucket, file, folder, size=None, metrics=None):
+    '''
+    download file into folder. On failure the message is left on the queue
+    and retried by SQS.
+
+    para: size: object size in bytes from the S3 event, for tuning transfer
+    para: metrics: download bytes and seconds are added into it
+
+    rtype: string, empty if failed
+    '''
     file_name = file.split('/')[-1]
     try:
-        s3.download_file(bucket, file, INPUT_PATH + file_name)
+        config = get_transfer_config(size, DOWNLOAD_WORKERS)
+        start = monotonic()
+        s3.download_file(bucket, file, folder + file_name, Config=config)
+        stats = log_transfer('download', file,
+                             os.path.getsize(folder + file_name),
+                             monotonic() - start, config)
+        if metrics is not None:
+            metrics['download_bytes'] = stats['bytes']
+            metrics['download_seconds'] = stats['seconds']
         logger.info('donwloaded file')
-        return INPUT_PATH + file_name
+        return folder + file_name
     except Exception as err:
-        # This part has problem. formate is wrong
-        # put the failed file info back to sqs
         logger.warn(err)
         logger.debug(traceback.format_exc())
-        logger.debug('message content: {}'.format(json.dumps(msg)))
-        logger.info('put message back to SQS for later try')
-        try:
-            sqs.send_message(QueueUrl=message_URL,
-                             MessageBody=json.dumps(msg))
-        except Exception as err:
-            logger.warn(err)
-            logger.debug(traceback.format_exc())
-            return ''
         return ''
 
 
-def run_program(input_file):
-    command = '%(command)s'
+def wait_child(process, start, metrics=None):
+    '''
+    wait for process started at monotonic time start, and add its peak
+    resident memory, cpu and wall time into metrics. The usage comes from
+    wait4() of this child only, other runs of the task are not counted.
 
-    file_name = input_file.split('/')[-1]
-    result_file = OUTPUT_PATH + 'Result-' + NAME + '-' + file_name
-    output_file_specified = True
+    rtype: int, exit code, negative signal number if killed
+    '''
+    _, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    if metrics is not None:
+        metrics['exit_code'] = process.returncode
+        # ru_maxrss is in KB on linux
+        metrics['peak_rss_mb'] = round(usage.ru_maxrss / 1024, 1)
+        metrics['cpu_seconds'] = round(usage.ru_utime + usage.ru_stime, 3)
+        metrics['wall_seconds'] = round(monotonic() - start, 3)
+    return process.returncode
+
+
+def get_metadata(cache_key, metrics=None):
+    '''
+    S3 metadata of a result: its result cache key and the resource profile
+    of the run producing it
+
+    rtype: dict
+    '''
+    metadata = {CACHE_METADATA: cache_key} if cache_key else {}
+    for name in PROFILE_FIELDS:
+        if metrics is not None and name in metrics:
+            metadata['yunpipe-' + name.replace('_', '-')] = str(metrics[name])
+    return metadata
 
-    run_command = command.split()
-    for i in range(len(run_command)):
-        if run_command[i] == '$input':
-            run_command[i] = input_file
-        if run_command[i] == '$output':
+
+def build_command(input_file, result_file):
+    '''
+    substitute placeholders in COMMAND. $stdin and $stdout are dropped from
+    the command as they are served by pipes.
+
+    rtype: tuple, run command and whether $output is absent
+    '''
+    output_file_specified = True
+    run_command = []
+    for arg in COMMAND.split():
+        if arg == '$input':
+            arg = input_file
+        elif arg == '$output':
             output_file_specified = False
-            run_command[i] = result_file
+            arg = result_file
+        elif arg in ('$stdin', '$stdout'):
+            continue
+        run_command.append(arg)
+    return run_command, output_file_specified
 
-    # with open(input_file, 'r') as f:
-    #     print(f.read())
-    # print(run_command)
 
-    call(run_command)
+def collect_result(run_command, result_file, output_file_specified, folder):
+    '''
+    find the result file or folder of a finished run
 
-    # check if need to zip
+    rtype: string
+    '''
+    # folders are archived while uploading, see upload_archive()
     if not output_file_specified:
-        if os.path.isdir(result_file):
-            file_name = 'Result-' + NAME + '-' + file_name.split('.')[0] + '.zip'
-            call(['zip', '-rv9', file_name, result_file])
+        return result_file
+    return run_command[-1]
+
+
+def run_program(input_file, folder, metrics=None):
+    file_name = input_file.split('/')[-1]
+    result_file = folder + 'Result-' + NAME + '-' + file_name
+
+    run_command, output_file_specified = build_command(input_file,
+                                                       result_file)
+
+    start = monotonic()
+    code = wait_child(Popen(run_command), start, metrics)
+    if code != 0:
+        logger.warn('program exited with {}'.format(code))
+        return ''
+
+    return collect_result(run_command, result_file, output_file_specified,
+                          folder)
+
+
+def run_batch(jobs):
+    '''
+    run program once over the input files of jobs: $inputs is replaced by
+    all of them and $output_dir by one output folder. Inputs are linked into
+    a batch folder as index-name, so that inputs of the same name or stem do
+    not collide. The program names the result of each input after it,
+    either the staged file name or its name without extension. Several
+    results of one input are put into a folder.
+
+    rtype: list, result of each job, empty if the program gave none or
+    failed
+    '''
+    input_dir = mkdtemp(prefix='yunpipe-batch-', dir=INPUT_PATH) + '/'
+    output_dir = mkdtemp(prefix='yunpipe-batch-', dir=OUTPUT_PATH) + '/'
+    try:
+        return _run_batch(jobs, input_dir, output_dir)
+    finally:
+        rmtree(input_dir, ignore_errors=True)
+        rmtree(output_dir, ignore_errors=True)
+
+
+def _run_batch(jobs, input_dir, output_dir):
+    staged = []
+    for i, job in enumerate(jobs):
+        name = '{}-{}'.format(i, job['input_file'].split('/')[-1])
+        os.symlink(os.path.abspath(job['input_file']), input_dir + name)
+        staged.append(name)
+
+    run_command = []
+    for arg in COMMAND.split():
+        if arg == '$inputs':
+            run_command.extend(input_dir + name for name in staged)
+        elif arg == '$output_dir':
+            run_command.append(output_dir)
         else:
-            file_name = result_file
-    else:
-        if os.path.isdir(run_command[i]):
-            file_name = 'Result-' + NAME + '-' + file_name.split('.')[0] + '.zip'
-            call(['zip', '-rv9', file_name, run_command[i]])
+            run_command.append(arg)
+
+    logger.info('run program over {} files'.format(len(jobs)))
+    profile = {}
+    code = wait_child(Popen(run_command), monotonic(), profile)
+    # the profile is of the whole batch
+    for job in jobs:
+        job['metrics'].update(profile)
+    if code != 0:
+        # every file of the batch is retried, even if it has a result
+        logger.warn('program exited with {}'.format(code))
+        return [''] * len(jobs)
+
+    outputs = sorted(os.listdir(output_dir))
+    results = []
+    for i, (job, file_name) in enumerate(zip(jobs, staged)):
+        base = file_name.split('.')[0]
+        matched = [name for name in outputs
+                   if name == file_name or name.split('.')[0] == base]
+        for name in matched:
+            outputs.remove(name)
+
+        # drop the index prefix of staged names
+        prefix = len('{}-'.format(i))
+        result = job['output_folder'] + 'Result-' + NAME + '-'
+        if len(matched) == 0:
+            logger.warn('program gave no result for {}'.format(job['file']))
+            result = ''
+        elif len(matched) == 1:
+            result += matched[0][prefix:]
+            os.rename(output_dir + matched[0], result)
         else:
-            file_name = run_command[i]
-    return file_name
+            result += base[prefix:]
+            os.makedirs(result)
+            for name in matched:
+                os.rename(output_dir + name, result + '/' + name[prefix:])
+        results.append(result)
+
+    if outputs:
+        logger.warn('results not matching any input: {}'.format(outputs))
+    return results
+
+
+def stream_in(process, bucket, file, status, metrics=None):
+    '''
+    copy S3 object into the stdin of process as it arrives. status['ok'] is
+    set once the whole object is copied, and the bytes copied and seconds
+    taken go to metrics['download_bytes'] and metrics['download_seconds'].
+    '''
+    # one reader of STREAM_READ_SIZE chunks, logged like a transfer
+    config = TransferConfig(multipart_chunksize=STREAM_READ_SIZE,
+                            max_concurrency=1)
+    start = monotonic()
+    size = 0
+    try:
+        body = s3.get_object(Bucket=bucket, Key=file)['Body']
+        for chunk in iter(lambda: body.read(STREAM_READ_SIZE), b''):
+            process.stdin.write(chunk)
+            size += len(chunk)
+        stats = log_transfer('download', file, size, monotonic() - start,
+                             config)
+        if metrics is not None:
+            metrics['download_bytes'] = stats['bytes']
+            metrics['download_seconds'] = stats['seconds']
+        status['ok'] = True
+    except BrokenPipeError:
+        logger.warn('program stopped reading its input {}'.format(file))
+    except Exception as err:
+        logger.debug(traceback.format_exc())
+        logger.error('Unexpected error occures when streaming {}!!'.format(
+            file))
+        logger.error(err)
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def stream_out(stream, s3_key, metadata=None, metrics=None):
+    '''
+    upload stream into s3_key of UPLOADBUCKET by multipart upload. A part is
+    sent as soon as it is read, up to max_concurrency parts at a time. Parts
+    grow as their number rises, see PARTS_PER_SIZE, with fewer of them in
+    flight. The upload is aborted on failure. Bytes sent and seconds taken
+    go to metrics['upload_bytes'] and metrics['upload_seconds'].
+
+    para: metadata: S3 metadata of the object, see get_metadata()
+    type: dict
+
+    rtype: tuple, upload id and list of uploaded parts
+    '''
+    config = get_transfer_config(None, UPLOAD_WORKERS)
+    start = monotonic()
+    upload_id = s3.create_multipart_upload(Bucket=UPLOADBUCKET, Key=s3_key,
+                                           Metadata=metadata or {})['UploadId']
+
+    def upload_part(number, chunk):
+        res = s3.upload_part(Bucket=UPLOADBUCKET, Key=s3_key,
+                             UploadId=upload_id, PartNumber=number,
+                             Body=chunk)
+        return {'ETag': res['ETag'], 'PartNumber': number}
+
+    try:
+        running = set()
+        futures = []
+        size = 0
+        chunk_size = config.multipart_chunksize
+        limit = config.max_concurrency
+        grow_at = PARTS_PER_SIZE
+        with ThreadPoolExecutor(max_workers=config.max_concurrency) as pool:
+            chunk = stream.read(chunk_size)
+            # an empty output still needs one part
+            while chunk or not futures:
+                size += len(chunk)
+                while len(running) >= limit:
+                    _, running = wait(running, return_when=FIRST_COMPLETED)
+                future = pool.submit(upload_part, len(futures) + 1, chunk)
+                running.add(future)
+                futures.append(future)
+                if len(futures) == grow_at:
+                    # keep the bytes in flight as they were
+                    grow_at += PARTS_PER_SIZE
+                    chunk_size = min(MAX_PART_SIZE, chunk_size * 2)
+                    limit = max(1, config.max_concurrency *
+                                config.multipart_chunksize // chunk_size)
+                chunk = stream.read(chunk_size)
+        parts = [future.result() for future in futures]
+        stats = log_transfer('upload', s3_key, size, monotonic() - start,
+                             config)
+        if metrics is not None:
+            metrics['upload_bytes'] = stats['bytes']
+            metrics['upload_seconds'] = stats['seconds']
+        return upload_id, parts
+    except Exception:
+        s3.abort_multipart_upload(Bucket=UPLOADBUCKET, Key=s3_key,
+                                  UploadId=upload_id)
+        raise
+
+
+def run_streaming_program(job):
+    '''
+    run program with S3 object piped into its stdin if STREAM_INPUT, and its
+    stdout uploaded while it runs if STREAM_OUTPUT. Compute starts at the
+    first byte and neither side needs to fit on local disk.
+
+    rtype: string, result file or uploaded key; empty if failed
+    '''
+    file_name = job['input_file'].split('/')[-1]
+    result_file = job['output_folder'] + 'Result-' + NAME + '-' + file_name
+    run_command, output_file_specified = build_command(job['input_file'],
+                                                       result_file)
+    start = monotonic()
+    process = Popen(run_command,
+                    stdin=PIPE if STREAM_INPUT else None,
+                    stdout=PIPE if STREAM_OUTPUT else None)
+
+    feeder = None
+    status = {'ok': not STREAM_INPUT}
+    if STREAM_INPUT:
+        feeder = Thread(target=stream_in, name='stdin-' + file_name,
+                        args=(process, job['bucket'], job['file'], status,
+                              job['metrics']))
+        feeder.start()
+
+    if not STREAM_OUTPUT:
+        code = wait_child(process, start, job['metrics'])
+        feeder.join()
+        if code != 0:
+            logger.warn('program exited with {}'.format(code))
+            return ''
+        if not status['ok']:
+            return ''
+        return collect_result(run_command, result_file,
+                              output_file_specified, job['output_folder'])
+
+    s3_key = get_result_key(result_file, job['file'])
+    try:
+        upload_id, parts = stream_out(process.stdout, s3_key,
+                                      get_metadata(job['cache_key']),
+                                      job['metrics'])
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        code = wait_child(process, start, job['metrics'])
+        if feeder is not None:
+            feeder.join()
+
+    if code != 0:
+        logger.warn('program exited with {}'.format(code))
+    # the profile of the run is known only now, it goes to the profile log
+    # but not into the metadata of the uploaded result
+    return finish_stream(s3_key, upload_id, parts,
+                         code == 0 and status['ok'])
+
+
+def finish_stream(s3_key, upload_id, parts, succeeded):
+    '''
+    complete the multipart upload of a stream if succeeded, otherwise abort
+    it.
+
+    rtype: string, uploaded key, empty if aborted
+    '''
+    if not succeeded:
+        logger.warn('abort upload of {}'.format(s3_key))
+        s3.abort_multipart_upload(Bucket=UPLOADBUCKET, Key=s3_key,
+                                  UploadId=upload_id)
+        return ''
+    s3.complete_multipart_upload(Bucket=UPLOADBUCKET, Key=s3_key,
+                                 UploadId=upload_id,
+                                 MultipartUpload={'Parts': parts})
+    logger.info('streamed result to {}'.format(s3_key))
+    return s3_key
+
+
+class zip_writer:
+    '''
+    minimal zip writer for a non seekable stream, taking members which are
+    already compressed, so that they can be deflated in parallel. Zip64
+    records are written when sizes or offsets need them.
+    '''
+    # sizes and offsets from LIMIT on are stored in zip64 records, the
+    # classic fields then hold MAX
+    LIMIT = 0xFFFFFFFF
+    MAX = 0xFFFFFFFF
+
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.entries = []
+
+    def _write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def add(self, name, member):
+        '''
+        para: name: name of member in the archive
+        para: member: compressed member, see deflate_member()
+        type: dict
+        '''
+        name = name.encode('utf-8')
+        year, month, day, hour, minute, second = member['mtime'][:6]
+        dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+        zip64 = member['size'] >= self.LIMIT or \
+            member['compressed_size'] >= self.LIMIT
+        extra = b''
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, member['size'],
+                                member['compressed_size'])
 
+        entry = dict(member, name=name, date=dos_date, time=dos_time,
+                     offset=self.offset)
+        self.entries.append(entry)
 
-def upload_file(file, input_file):
+        self._write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, 0x800,
+            member['method'], dos_time, dos_date, member['crc'],
+            self.MAX if zip64 else member['compressed_size'],
+            self.MAX if zip64 else member['size'], len(name), len(extra)))
+        self._write(name + extra)
+        for chunk in iter(lambda: member['data'].read(MB), b''):
+            self._write(chunk)
+
+    def close(self):
+        '''
+        write the central directory
+        '''
+        start = self.offset
+        for entry in self.entries:
+            extra = b''
+            fields = []
+            for value in (entry['size'], entry['compressed_size'],
+                          entry['offset']):
+                if value >= self.LIMIT:
+                    extra += struct.pack('<Q', value)
+                    value = self.MAX
+                fields.append(value)
+            size, compressed_size, offset = fields
+            if extra:
+                extra = struct.pack('<HH', 1, len(extra)) + extra
+            version = 45 if extra else 20
+            self._write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version,
+                0x800, entry['method'], entry['time'], entry['date'],
+                entry['crc'], compressed_size, size, len(entry['name']),
+                len(extra), 0, 0, 0, 0o100644 << 16, offset))
+            self._write(entry['name'] + extra)
+        end = self.offset
+
+        count = len(self.entries)
+        size = end - start
+        if count >= 0xFFFF or start >= self.LIMIT or size >= self.LIMIT:
+            self._write(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, 3 << 8 | 45, 45, 0, 0,
+                count, count, size, start))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+            count, size, start = 0xFFFF, self.MAX, self.MAX
+        self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                                size, start, 0))
+
+
+def deflate_member(path):
+    '''
+    compress one file into a spooled temporary file with raw deflate, or
+    store it if ARCHIVE_LEVEL is 0.
+
+    rtype: dict
+    '''
+    data = SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+    compressor = None
+    if ARCHIVE_LEVEL > 0:
+        compressor = zlib.compressobj(ARCHIVE_LEVEL, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    with open(path, 'rb') as tmpfile:
+        for chunk in iter(lambda: tmpfile.read(MB), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        data.write(compressor.flush())
+    compressed_size = data.tell()
+    data.seek(0)
+    return {'data': data, 'crc': crc, 'size': size,
+            'compressed_size': compressed_size,
+            'method': zlib.DEFLATED if compressor else 0,
+            'mtime': time.localtime(os.path.getmtime(path))}
+
+
+def write_zip(members, out):
+    '''
+    write members, a list of (path, name), as zip into out. Members are
+    compressed by ARCHIVE_THREADS threads and written in order.
+    '''
+    archive = zip_writer(out)
+    running = deque()
+    with ThreadPoolExecutor(max_workers=ARCHIVE_THREADS,
+                            thread_name_prefix='deflate') as pool:
+        for path, name in members:
+            # bound the compressed members waiting to be written
+            if len(running) >= ARCHIVE_THREADS * 2:
+                write_member(archive, *running.popleft())
+            running.append((name, pool.submit(deflate_member, path)))
+        while running:
+            write_member(archive, *running.popleft())
+    archive.close()
+
+
+def write_member(archive, name, future):
+    member = future.result()
+    try:
+        archive.add(name, member)
+    finally:
+        member['data'].close()
+
+
+def write_archive(folder, out):
+    '''
+    archive folder into out in ARCHIVE_FORMAT. Names in the archive start
+    with the folder name.
+    '''
+    folder = folder.rstrip('/')
+    parent = os.path.dirname(folder)
+    if ARCHIVE_FORMAT == 'zip':
+        members = []
+        for root, _, files in os.walk(folder):
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                members.append((path, os.path.relpath(path, parent)))
+        write_zip(members, out)
+    elif ARCHIVE_FORMAT == 'tar.zst':
+        compressor = zstandard.ZstdCompressor(level=ARCHIVE_LEVEL,
+                                              threads=ARCHIVE_THREADS)
+        with compressor.stream_writer(out) as writer:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                tar.add(folder, arcname=os.path.basename(folder))
+    else:
+        with tarfile.open(fileobj=out, mode='w|') as tar:
+            tar.add(folder, arcname=os.path.basename(folder))
+
+
+def upload_archive(folder, input_file, cache_key=None, metrics=None):
+    '''
+    archive result folder in ARCHIVE_FORMAT and stream the archive into a
+    multipart upload while it is written. Archive and upload seconds and
+    uploaded bytes go to metrics.
+
+    rtype: string, uploaded key, empty if failed
+    '''
+    base = input_file.split('/')[-1].split('.')[0]
+    name = 'Result-' + NAME + '-' + base + ARCHIVE_EXTENSION[ARCHIVE_FORMAT]
+    s3_key = get_result_key(name, input_file)
+
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    writer = os.fdopen(write_fd, 'wb')
+    status = {'ok': False}
+    if metrics is None:
+        metrics = {}
+
+    def archive():
+        start = monotonic()
+        try:
+            write_archive(folder, writer)
+            status['ok'] = True
+            metrics['archive_seconds'] = round(monotonic() - start, 3)
+        except Exception as err:
+            logger.debug(traceback.format_exc())
+            logger.error('Unexpected error occures when archiving {}!!'
+                         .format(folder))
+            logger.error(err)
+        finally:
+            try:
+                writer.close()
+            except BrokenPipeError:
+                pass
+
+    thread = Thread(target=archive, name='archive-' + base)
+    thread.start()
+    try:
+        upload_id, parts = stream_out(reader, s3_key,
+                                      get_metadata(cache_key, metrics),
+                                      metrics)
+    except Exception as err:
+        logger.debug(traceback.format_exc())
+        logger.error('Unexpected error happened while uploading archive')
+        logger.error(err)
+        return ''
+    finally:
+        # unblock the archive thread if upload stopped reading
+        reader.close()
+        thread.join()
+    return finish_stream(s3_key, upload_id, parts, status['ok'])
+
+
+def get_result_key(file, input_file):
+    '''
+    result key of file: the key of the input file, with the file name
+    replaced by result file name
+
+    rtype: string
+    '''
     path = input_file.split('/')
     path[-1] = file.split('/')[-1]
-    s3_key = '/'.join(path)
+    return '/'.join(path)
+
+
+def upload_file(file, input_file, cache_key=None, metrics=None):
+    '''
+    para: cache_key: result cache key saved as object metadata
+    para: metrics: upload bytes and seconds are added into it
+
+    rtype: boolean, True if uploaded
+    '''
+    s3_key = get_result_key(file, input_file)
     try:
-        s3.upload_file(file, UPLOADBUCKET, s3_key)
+        size = os.path.getsize(file)
+        config = get_transfer_config(size, UPLOAD_WORKERS)
+        start = monotonic()
+        extra = {'Metadata': get_metadata(cache_key, metrics)}
+        s3.upload_file(file, UPLOADBUCKET, s3_key, Config=config,
+                       ExtraArgs=extra)
+        stats = log_transfer('upload', s3_key, size, monotonic() - start,
+                             config)
+        if metrics is not None:
+            metrics['upload_bytes'] = stats['bytes']
+            metrics['upload_seconds'] = stats['seconds']
+        return True
     except botocore.exceptions.ClientError as err:
         logger.warn(err)
     except Exception as err:
         logger.debug(traceback.format_exc())
         logger.error('Unexpected error happened while uploading file to output S3 bucket')
         logger.error(err)
+    return False
 
 
 if __name__ == '__main__':
     pull_files(QUEUEURL)
+    # tasks of a service keep waiting for messages until ECS stops them
+    while SERVICE_MODE:
+        pull_files(QUEUEURL)
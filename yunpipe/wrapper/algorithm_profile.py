@@ -0,0 +1,120 @@
+import json
+from math import ceil
+from os.path import join
+
+from .. import CLOUD_PIPE_ALGORITHM_FOLDER
+
+# key prefix of profiles the runscript uploads into output bucket
+PROFILE_PREFIX = '.yunpipe-profile/'
+
+# extra memory on top of the highest peak seen, and the granularity of
+# suggested memory (MB) and cpu (ECS cpu units)
+MEMORY_HEADROOM = 1.2
+MEMORY_STEP = 32
+CPU_UNITS = 1024
+CPU_STEP = 128
+
+
+def load_profiles(s3, bucket, name):
+    '''
+    read the resource profiles of algorithm name from bucket
+
+    :para s3: boto3 s3 client
+    :para bucket: output bucket of a stage running the algorithm
+    :type: string
+
+    :para name: algorithm name
+    :type: string
+
+    :rtype: list of dict
+    '''
+    profiles = []
+    paginator = s3.get_paginator('list_objects_v2')
+    prefix = PROFILE_PREFIX + name + '/'
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            body = s3.get_object(Bucket=bucket, Key=obj['Key'])['Body']
+            for line in body.read().decode().splitlines():
+                if line.strip():
+                    profiles.append(json.loads(line))
+    return profiles
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(ceil(percent / 100 * len(values))) - 1
+    return values[max(0, index)]
+
+
+def summarize_profiles(profiles):
+    '''
+    aggregate profiles of successful runs over a single file. Runs of a
+    batch are profiled as a whole and skipped.
+
+    :rtype: dict, None if there is no usable profile
+    '''
+    runs = [p for p in profiles
+            if p.get('exit_code') == 0 and p.get('batch_size', 1) == 1 and
+            p.get('wall_seconds')]
+    if not runs:
+        return None
+
+    rss = [p['peak_rss_mb'] for p in runs]
+    cpus = [p['cpu_seconds'] / p['wall_seconds'] for p in runs]
+    walls = [p['wall_seconds'] for p in runs]
+    return {'runs': len(runs),
+            'peak_rss_mb': max(rss),
+            'p95_rss_mb': _percentile(rss, 95),
+            'p95_cpus': round(_percentile(cpus, 95), 3),
+            'mean_cpus': round(sum(cpus) / len(cpus), 3),
+            'mean_wall_seconds': round(sum(walls) / len(walls), 3),
+            'max_wall_seconds': max(walls)}
+
+
+def suggest_resources(summary):
+    '''
+    memory and CPU settings of the algorithm info covering the runs in
+    summary: minimal memory is the highest peak, suggested memory adds
+    MEMORY_HEADROOM, and CPU is the 95th percentile of cpus used.
+
+    :rtype: dict, {'memory': {'minimal', 'suggested'}, 'CPU'}
+    '''
+    minimal = int(ceil(summary['peak_rss_mb']))
+    suggested = int(ceil(summary['peak_rss_mb'] * MEMORY_HEADROOM /
+                         MEMORY_STEP)) * MEMORY_STEP
+    units = max(CPU_STEP, int(ceil(summary['p95_cpus'] * CPU_UNITS /
+                                   CPU_STEP)) * CPU_STEP)
+    return {'memory': {'minimal': minimal, 'suggested': suggested},
+            'CPU': units / CPU_UNITS}
+
+
+def read_algorithm_info(name):
+    '''
+    :para name: the name the algorithm is refered as in user request
+    :type: string
+
+    :rtype: dict, content of ~/.cloud_pipe/algorithms/name_info.json
+    '''
+    file_path = join(CLOUD_PIPE_ALGORITHM_FOLDER, name + '_info.json')
+    with open(file_path, 'r') as data_file:
+        return json.load(data_file)
+
+
+def update_algorithm_info(name, suggestion):
+    '''
+    write suggested memory and CPU into ~/.cloud_pipe/algorithms/name_info.json
+
+    :para name: the name the algorithm is refered as in user request
+    :type: string
+
+    :rtype: dict, updated algorithm info
+    '''
+    file_path = join(CLOUD_PIPE_ALGORITHM_FOLDER, name + '_info.json')
+    info = read_algorithm_info(name)
+
+    info['memory'] = suggestion['memory']
+    info['CPU'] = suggestion['CPU']
+
+    with open(file_path, 'w') as data_file:
+        json.dump(info, data_file, indent='    ', sort_keys=True)
+    return info
@@ -14,6 +14,12 @@ from ..utils import get_true_or_false
 
 SUPPORTED_SYSTEM = {'ubuntu'}
 
+# optional variables algorithm users can set to tune runscript
+RUNSCRIPT_VARIABLES = ['WORKERS', 'DOWNLOAD_WORKERS', 'UPLOAD_WORKERS',
+                       'QUEUE_SIZE', 'STATS_INTERVAL', 'VISIBILITY_TIMEOUT',
+                       'INPUT_CACHE_SIZE', 'ARCHIVE_THREADS',
+                       'METRICS_OUTPUT']
+
 
 def generate_dockerfile(system_name, container_name):
     '''
@@ -85,7 +91,7 @@ def describe_algorithm():
     info['system'] = input(
         'Please input which operating system your container is build on:\n')
     info['run_command'] = input(
-        'Please input the run command of your algorithm, substituting input file with "$input", output file/folder with "$output", using full path for executable. for example, sh /User/YX/run.sh $input -d $output:\n')
+        'Please input the run command of your algorithm, substituting input file with "$input", output file/folder with "$output", using full path for executable. Use "$stdin" / "$stdout" instead if your algorithm reads input from stdin / writes output to stdout, so files are streamed without touching local disk. If your algorithm can process many files in one run, use "$inputs" for the list of input files and "$output_dir" for the folder where the result of each input is named after it. for example, sh /User/YX/run.sh $input -d $output:\n')
     info['input_file_path'] = input(
         'Please input full path to the folder where input file should be:\n')
     info['output_file_path'] = input(
@@ -261,6 +267,10 @@ def generate_image_info(alg_info, container_name):
     new_vars.append({'name': 'AWS_ACCESS_KEY_ID', 'required': True})
     new_vars.append({'name': 'AWS_SECRET_ACCESS_KEY', 'required': True})
 
+    # runscript tuning, see runscript_template
+    for name in RUNSCRIPT_VARIABLES:
+        new_vars.append({'name': name, 'required': False})
+
     alg_info['container_name'] = container_name
     if alg_info['instance_type'] == '':
         alg_info['instance_type'] = get_instance_type(alg_info)